@@ -0,0 +1,189 @@
+# -*-coding:utf8;-*-
+"""SqliteQueue的性能测试，统计吞吐量与从注册到回调的延迟。
+
+运行：python -m benchmark --help
+"""
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import sqlite_queue
+
+OPERATIONS = ('execute', 'insert', 'select', 'update', 'peewee')
+DEFAULT_MIX = {'execute': 1, 'insert': 1, 'select': 1, 'update': 1}
+_PRELOAD_ROWS = 1000
+
+if sqlite_queue.__peewee__:
+    import peewee
+
+    class _Bench(peewee.Model):
+        k = peewee.IntegerField()
+        v = peewee.TextField()
+
+        class Meta:
+            database = peewee.SqliteDatabase(None)
+            table_name = 'bench'
+
+
+def _percentile(values, p):
+    """
+    :param values: 已排序的数据
+    :param p: 百分位，0~1
+    :return:
+    """
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def _submit(queue, operation, rnd):
+    """
+    按操作类型注册一个任务
+    :return: future，出错的任务不会调用回调，用future才能统计到
+    """
+    k = rnd.randrange(_PRELOAD_ROWS)
+    if operation == 'execute':
+        return queue.submit_execute('INSERT INTO bench (`k`,`v`) VALUES (?,?)', (k, 'execute'))
+    elif operation == 'insert':
+        return queue.insert('bench').data({'k': k, 'v': 'insert'}).submit()
+    elif operation == 'select':
+        return queue.select('bench').where('id', k + 1).submit()
+    elif operation == 'update':
+        return queue.update('bench', {'v': 'update'}).where('id', k + 1).submit()
+    elif operation == 'peewee':
+        return queue.submit_peewee_query(_Bench.insert(k=k, v='peewee'))
+    else:
+        raise ValueError('Unknown operation: ' + operation)
+
+
+def run_queue(db, producers=4, ops=10000, mix=None, **options):
+    """
+    多个线程同时向SqliteQueue注册任务，统计吞吐量与延迟
+    :param db: 数据库文件，可以是:memory:
+    :param producers: 注册任务的线程数
+    :param ops: 任务总数
+    :param mix: 操作类型到权重的dict，见OPERATIONS
+    :param options: 传给SqliteQueue的参数
+    :return: 结果dict，延迟单位微秒
+    """
+    mix = dict(mix or DEFAULT_MIX)
+    if mix.get('peewee') and not sqlite_queue.__peewee__:
+        raise sqlite_queue.SqliteQueueError('Module "peewee" have not been installed.')
+    queue = sqlite_queue.SqliteQueue(db, **options)
+    queue.start()
+    queue.submit_execute('CREATE TABLE IF NOT EXISTS bench(id INTEGER PRIMARY KEY AUTOINCREMENT, k INTEGER, v TEXT)')
+    queue.submit_execute('INSERT INTO bench (`k`,`v`) VALUES (?,?)',
+                         [(i, 'preload') for i in range(_PRELOAD_ROWS)]).result()
+
+    operations = [op for op in mix for _ in range(mix[op])]
+    latencies = []
+    lock = threading.Lock()
+    finished = threading.Event()
+    remain = [ops]
+    errors = [0]
+
+    def produce(count, seed):
+        rnd = random.Random(seed)
+        local = []
+        for _ in range(count):
+            start = time.perf_counter()
+
+            def done(future, start=start):
+                local.append(time.perf_counter() - start)
+                with lock:
+                    if future.exception() is not None:
+                        errors[0] += 1
+                    remain[0] -= 1
+                    if remain[0] == 0:
+                        finished.set()
+
+            _submit(queue, rnd.choice(operations), rnd).add_done_callback(done)
+        finished.wait()
+        with lock:
+            latencies.extend(local)
+
+    counts = [ops // producers + (1 if i < ops % producers else 0) for i in range(producers)]
+    threads = [threading.Thread(target=produce, args=(n, i)) for i, n in enumerate(counts)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    finished.wait()
+    elapsed = time.perf_counter() - start
+    for t in threads:
+        t.join()
+    queue.stop()
+    queue.join()
+
+    latencies.sort()
+    return {
+        'db': 'memory' if db == ':memory:' else 'file',
+        'producers': producers,
+        'ops': ops,
+        'mix': mix,
+        'options': {k: v for k, v in options.items() if isinstance(v, (int, float, str, bool))},
+        'seconds': elapsed,
+        'ops_per_sec': ops / elapsed if elapsed > 0 else 0.0,
+        'errors': errors[0],
+        'latency_us': {name: _percentile(latencies, p) * 1e6
+                       for name, p in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1.0))}
+    }
+
+
+def run_get_sql(iterations=20000):
+    """
+    统计SqlQuery生成SQL语句的耗时
+    :param iterations: 次数
+    :return: 每种语句每次生成的耗时，单位微秒
+    """
+    builders = {
+        'select': lambda: sqlite_queue.SqlQuery('bench').field('id', 'k').where({
+            'k[>=]': 10, 'v': ['a', 'b', 'c'], 'id[><]': [1, 100]}).order('k').limit(0, 10),
+        'insert': lambda: sqlite_queue.SqlQuery('bench', method='INSERT', params={'k': 1, 'v': 'a'}),
+        'insert_bulk': lambda: sqlite_queue.SqlQuery('bench', method='INSERT',
+                                                     params=[{'k': i, 'v': 'a'} for i in range(100)]),
+        'update': lambda: sqlite_queue.SqlQuery('bench', method='UPDATE', params={'v': 'a'}).where('id', 1),
+    }
+    result = {}
+    for name, build in builders.items():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            build().get_sql()
+        result[name] = (time.perf_counter() - start) / iterations * 1e6
+    return result
+
+
+def run_all(dbs=('memory', 'file'), producers=(1, 4), ops=10000, mix=None, **options):
+    """
+    运行全部测试
+    :param dbs: 'memory'与/或'file'
+    :param producers: 要测试的线程数
+    :param ops: 每项测试的任务总数
+    :param mix: 操作类型到权重的dict
+    :param options: 传给SqliteQueue的参数
+    :return: 可直接保存为JSON的结果
+    """
+    results = []
+    for db in dbs:
+        for n in producers:
+            if db == 'memory':  # 内存数据库不支持读连接
+                results.append(run_queue(':memory:', n, ops, mix,
+                                         **{k: v for k, v in options.items() if k != 'readers'}))
+                continue
+            directory = tempfile.mkdtemp(prefix='sqlite_queue_bench')
+            try:
+                results.append(run_queue(os.path.join(directory, 'bench.db'), n, ops, mix, **options))
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'version': sqlite_queue.__version__,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'queue': results,
+        'get_sql_us': run_get_sql()
+    }
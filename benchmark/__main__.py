@@ -0,0 +1,50 @@
+# -*-coding:utf8;-*-
+import argparse
+import json
+import sys
+
+from benchmark import OPERATIONS, run_all
+
+
+def _parse_mix(text):
+    """
+    解析形如 insert=2,select=1 的操作权重
+    """
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation: ' + name)
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description='Benchmark SqliteQueue.')
+    parser.add_argument('--db', choices=['memory', 'file'], action='append',
+                        help='database to test, repeatable (default: both)')
+    parser.add_argument('--producers', type=int, action='append',
+                        help='number of producer threads, repeatable (default: 1 and 4)')
+    parser.add_argument('--ops', type=int, default=10000, help='tasks per run (default: 10000)')
+    parser.add_argument('--mix', type=_parse_mix, default=None,
+                        help='operation weights, e.g. execute=1,insert=1,select=1,update=1,peewee=1')
+    parser.add_argument('--batch-size', type=int, default=1, help='SqliteQueue batch_size (default: 1)')
+    parser.add_argument('--readers', type=int, default=0, help='SqliteQueue readers, ignored for memory db (default: 0)')
+    parser.add_argument('--output', '-o', help='write JSON result to this file instead of stdout')
+    args = parser.parse_args(argv)
+
+    options = {'batch_size': args.batch_size}
+    if args.readers:
+        options['readers'] = args.readers
+    result = run_all(dbs=args.db or ('memory', 'file'), producers=args.producers or (1, 4),
+                     ops=args.ops, mix=args.mix, **options)
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
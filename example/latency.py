@@ -0,0 +1,32 @@
+import threading
+import time
+
+import sqlite_queue
+
+# 配置数据库，内存库即可
+queue = sqlite_queue.SqliteQueue(':memory:')
+queue.start()
+
+queue.register_execute("CREATE TABLE `t`(id INTEGER PRIMARY KEY AUTOINCREMENT, v INTEGER)")
+
+# 测试提交到执行回调的延迟。每次提交前先让队列空闲一段时间，确保工作线程处于等待状态
+latencies = []
+done = threading.Event()
+for i in range(50):
+    time.sleep(0.01)
+    done.clear()
+    start = time.perf_counter()
+
+    def callback(lst_rowid):
+        latencies.append(time.perf_counter() - start)
+        done.set()
+
+    queue.register_execute("INSERT INTO t (`v`) VALUES (?)", (i,), callback=callback)
+    done.wait()
+
+latencies.sort()
+print('submit-to-execute latency (us): p50=%.1f p99=%.1f max=%.1f' % (
+    latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * 0.99)] * 1e6, latencies[-1] * 1e6))
+
+queue.stop()
+queue.join()
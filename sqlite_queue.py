@@ -1,10 +1,26 @@
 # -*-coding:utf8;-*-
+import os
 import sqlite3
 import queue
 import threading
 import time
 import re
 import inspect
+import types
+import functools
+import logging
+import asyncio
+import pickle
+import zlib
+import json
+import copy
+import marshal
+import itertools
+import array
+import weakref
+import multiprocessing.connection
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import Future, CancelledError, ThreadPoolExecutor
 
 __peewee__ = True
 try:
@@ -12,6 +28,12 @@ try:
 except ImportError:
     __peewee__ = False
 
+__numpy__ = True
+try:
+    import numpy
+except ImportError:
+    __numpy__ = False
+
 """基于python实现的sqlite队列，方便的处理sqlite并发。
 
 讲道理，写这个库的人并不会写python。SqliteQueue是继承了threading.Thread的线程，并且维护了一个向sqlite请求的队列。
@@ -22,6 +44,65 @@ __author__ = "KAAAsS"  # ←超帅
 __version__ = '0.1.0'
 __license__ = "GPL v2"
 
+_logger = logging.getLogger(__name__)
+
+QueryResult = namedtuple('QueryResult', ['lst_rowid', 'data', 'rowcount', 'columns'], defaults=(None,))
+_RESULT_INDEX = {name: index for index, name in enumerate(QueryResult._fields)}
+
+_READ_ONLY_SQL = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+_WITH_SQL = re.compile(r'^\s*WITH\b', re.IGNORECASE)
+_WRITE_KEYWORD = re.compile(r'\b(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+_LANE_NAMES = ('interactive', 'normal', 'bulk')
+_LANE_WEIGHTS = (16, 4, 1)  # 每轮各优先级最多出队的任务数
+
+_TABLE_NAME = r'((?:[`"\[]?\w+[`"\]]?\.)?[`"\[]?\w+[`"\]]?)'
+_READ_TABLE = re.compile(r'\b(?:FROM|JOIN)\s+' + _TABLE_NAME, re.IGNORECASE)
+# 子查询或逗号连接的表，无法可靠解析出全部读取的表
+_COMPLEX_FROM = re.compile(r'\b(?:FROM|JOIN)\s*\(|\b(?:FROM|JOIN)\s+' + _TABLE_NAME + r'(?:\s+(?:AS\s+)?\w+)?\s*,',
+                           re.IGNORECASE)
+_WRITE_TABLE = re.compile(r'^\s*(?:(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM|'
+                          r'DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE)\s+' + _TABLE_NAME, re.IGNORECASE)
+_NO_WRITE_SQL = re.compile(r'^\s*(?:CREATE|BEGIN|COMMIT|END|SAVEPOINT|RELEASE)\b', re.IGNORECASE)
+
+# 分片合并时解析的排序字段，如`a` DESC
+_ORDER_TERM = re.compile(r'^\s*(?:\w+\.)?[`"\[]?(\w+)[`"\]]?(?:\s+(ASC|DESC))?\s*$', re.IGNORECASE)
+
+# 连接参数预设，打开连接时以PRAGMA设置。cache_size为负数时单位为KB
+PROFILES = {
+    # 每次提交都刷盘，掉电也不丢已提交的数据
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'busy_timeout': 5000},
+    # WAL模式下进程崩溃不丢数据，掉电可能丢失最近的提交
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -64 * 1024,
+                 'mmap_size': 256 * 1024 * 1024, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+    # 大量导入用，不等待刷盘，崩溃可能损坏数据库
+    'fast-ingest': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -256 * 1024,
+                    'mmap_size': 256 * 1024 * 1024, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+}
+_CONNECTION_PRAGMAS = ('cache_size', 'mmap_size', 'temp_store', 'busy_timeout')  # 读连接也需要设置的参数
+_WAL_CHECK_INTERVAL = 1  # 检查WAL文件大小的间隔，单位秒
+
+_COLUMN_CHUNK = 4096  # 按列返回结果时每次fetchmany的行数
+
+# IN的值超过该数量时改为绑定一个JSON数组参数，避免超过sqlite的参数个数限制，也不用每次编译很长的语句
+_IN_LIST_JSON = 256
+try:
+    sqlite3.connect(':memory:').execute("SELECT value FROM json_each('[1]')").close()
+    _HAS_JSON_EACH = True
+except sqlite3.Error:  # 未编译JSON扩展的旧版sqlite
+    _HAS_JSON_EACH = False
+
+# 溢写到磁盘时留在内存中的任务字段
+_SPILL_LOCAL = ('callback', 'future', 'plan', 'thread', 'stream', 'followers')
+_SPILL_LOAD = 64  # 每次从磁盘读回的任务数
+
+_PHASES = ('queue', 'execute', 'commit', 'callback', 'total')
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
 _OPERATOR_MAPPING = {
     "!": "!=",
     "~": "LIKE",
@@ -30,86 +111,873 @@ _OPERATOR_MAPPING = {
 
 
 class SqliteQueue(threading.Thread):
-    def __init__(self, db, wait=5):
+    def __init__(self, db, wait=5, idle_callback=None, batch_size=1, batch_wait=0, readers=0,
+                 callback_executor=None, ordered_callbacks=True, coalesce_reads=False, cache_size=0, cache_ttl=None,
+                 maxsize=0, max_bytes=0, put_timeout=None, high_watermark=None, low_watermark=None,
+                 on_high_watermark=None, on_low_watermark=None, metrics=True, metrics_hook=None, metrics_interval=10,
+                 spill_path=None, spill_bytes=64 * 1024 * 1024, recover_spill=False, profile=None, pragmas=None,
+                 checkpoint=True, wal_truncate_bytes=64 * 1024 * 1024, coalesce_updates=False):
         """
         :param db: sqlite数据库文件
-        :param wait: 任务等候时间，单位秒，默认5
+        :param wait: 空闲超时时间，单位秒，默认5。队列持续空闲超过该时间会调用idle_callback，None则一直等待
+        :param idle_callback: 空闲回调，在工作线程中调用，可用于做一些维护工作
+        :param batch_size: 组提交时单个事务最多包含的任务数，默认1即每个任务单独提交
+        :param batch_wait: 组提交时等待后续任务的时间窗口，单位秒，默认0即只取队列中已有的任务
+        :param readers: 读连接数。大于0时数据库以WAL模式打开，只读语句交给读线程并发执行，本线程只负责写
+        :param callback_executor: 执行回调的executor，None则在工作线程中直接回调，整数则新建该大小的线程池
+        :param ordered_callbacks: 使用callback_executor时，同一线程注册的任务是否按注册顺序回调
+        :param coalesce_reads: 是否合并相同的只读语句。语句、参数与优先级都相同的读任务在排队或执行中，
+                               且之后没有写入相关的表时，后注册的任务共享其结果
+        :param cache_size: SqlQuery查询结果缓存的条数，默认0即不缓存。写操作会使相关表的缓存失效
+        :param cache_ttl: 缓存有效时间，单位秒，None则不过期
+        :param maxsize: 队列最多排队的任务数，默认0即不限制。写队列与读队列分别计算
+        :param max_bytes: 队列中任务的SQL与参数最多占用的字节数(估计值)，默认0即不限制
+        :param put_timeout: 队列满时注册任务最多等待的时间，单位秒。None则一直等待，0则立即以SqliteQueueFull报错
+                            注册时可以用block与timeout参数单独指定
+        :param high_watermark: 排队任务数达到该值时调用on_high_watermark
+        :param low_watermark: 达到高水位后，排队任务数降到该值时调用on_low_watermark，默认与high_watermark相同
+        :param on_high_watermark: 高水位回调，参数为当前排队任务数，可用于通知上游限流
+        :param on_low_watermark: 低水位回调，参数为当前排队任务数
+        :param metrics: 是否按语句统计各阶段耗时，开销很小，默认开启
+        :param metrics_hook: 定时在工作线程中以stats()的结果调用，可用于推送到监控系统
+        :param metrics_interval: 调用metrics_hook的间隔，单位秒
+        :param spill_path: 溢写文件。设置后写队列中任务的SQL与参数超过spill_bytes时，后续任务写入该文件，执行到时再按顺序读回
+                           设置后不合并UPDATE，没有读线程时也不合并读任务
+        :param spill_bytes: 写队列在内存中最多占用的字节数(估计值)，默认64MB
+        :param recover_spill: 是否执行溢写文件中上次未执行的任务，如进程崩溃前积压的写操作。
+                              只恢复SQL与参数，回调与future无法恢复；崩溃时正在执行的任务可能丢失
+        :param profile: 连接参数预设，'durable'、'balanced'或'fast-ingest'，见PROFILES。None则使用sqlite默认值
+        :param pragmas: 额外的连接参数，如{'cache_size': -32768}，覆盖预设中的同名参数
+        :param checkpoint: WAL模式下是否在空闲时执行PASSIVE检查点，把WAL中的数据写回数据库
+        :param wal_truncate_bytes: WAL文件超过该大小时执行TRUNCATE检查点截断文件，None则不检查
+        :param coalesce_updates: 是否合并排队中的UPDATE。SqlQuery构建的UPDATE条件只有一个字段相等时，
+                                 表、字段、值与优先级都相同的UPDATE在还未执行时合并为一条语句，同名字段以后注册的为准，
+                                 每个任务的回调与future仍会完成。设置spill_path时不合并
         """
+        if readers > 0 and db == ':memory:':
+            raise SqliteQueueError('Reader connections are not supported for in-memory database!')
+        if profile is not None and profile not in PROFILES:
+            raise SqliteQueueError('Illegal param! Unknown profile: %s' % profile)
         threading.Thread.__init__(self)
         self.daemon = True  # 默认为守护线程
-        self._queue = queue.Queue()
+        limits = {'maxsize': maxsize, 'max_bytes': max_bytes, 'put_timeout': put_timeout,
+                  'high_watermark': high_watermark, 'low_watermark': low_watermark,
+                  'on_high_watermark': on_high_watermark, 'on_low_watermark': on_low_watermark}
+        self._queue = _TaskScheduler(self._expire_task, spill_path=spill_path, spill_bytes=spill_bytes,
+                                     recover_spill=recover_spill, **limits)
+        self._spill_path = spill_path
         self.wait = wait
+        self.idle_callback = idle_callback
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
         self._db = db
         self._conn = None
         self._cursor = None
+        self._stopping = False
+        self.readers = readers
+        self._read_queue = _TaskScheduler(self._expire_task, **limits)
+        self._reader_threads = []
+        if isinstance(callback_executor, int):
+            self._callback_executor = ThreadPoolExecutor(callback_executor, thread_name_prefix='sqlite_queue_callback')
+            self._own_executor = True
+        else:
+            self._callback_executor = callback_executor
+            self._own_executor = False
+        self.ordered_callbacks = ordered_callbacks
+        self._serial_dispatcher = None if callback_executor is None else _SerialDispatcher(self._callback_executor)
+        self._stats_lock = threading.Lock()
+        self.coalesce_reads = coalesce_reads
+        self.coalesce_updates = coalesce_updates
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}  # 排队或执行中的合并任务，见_coalesce与_merge_update
+        self._cache = _ResultCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self._metrics = _Metrics() if metrics else None
+        self.metrics_hook = metrics_hook
+        self.metrics_interval = metrics_interval
+        self._last_report = time.monotonic()
+        self._created = time.monotonic()
+        self._stats = {'worker_busy': 0.0, 'reader_busy': 0.0, 'callback_busy': 0.0, 'tasks': 0, 'callbacks': 0,
+                       'coalesce_hits': 0, 'coalesce_merges': 0, 'cache_hits': 0, 'cache_misses': 0,
+                       'checkpoints': 0, 'wal_truncates': 0, 'update_merges': 0}
+        self.pragmas = dict(PROFILES[profile]) if profile is not None else {}
+        self.pragmas.update(pragmas or {})
+        if readers > 0:  # WAL模式下读写互不阻塞
+            self.pragmas['journal_mode'] = 'WAL'
+        self.checkpoint = checkpoint
+        self.wal_truncate_bytes = wal_truncate_bytes
+        self._wal = False  # 连接是否处于WAL模式
+        self._wal_dirty = False  # 上次检查点之后是否有提交
+        self._last_wal_check = time.monotonic()
 
     def run(self):
         self._conn = sqlite3.connect(self._db)  # 链接sqlite库
         self._cursor = self._conn.cursor()  # 获取cursor
-        while True:
-            if self._queue.qsize() < 1:  # 如果队列空则sleep线程一段时间，以等待新操作
-                time.sleep(self.wait)
+        for name, value in self.pragmas.items():
+            row = self._cursor.execute('PRAGMA %s=%s' % (name, value)).fetchone()
+            if name == 'journal_mode':
+                self._wal = row is not None and str(row[0]).lower() == 'wal'
+        if self.readers > 0:
+            for _ in range(self.readers):
+                reader = _SqliteReader(self)
+                reader.start()
+                self._reader_threads.append(reader)
+        while not self._stopping:
+            try:  # 阻塞在队列上，有任务注册时立即唤醒
+                task = self._queue.get(timeout=self.wait)
+            except queue.Empty:  # 空闲超时
+                self._on_idle()
                 continue
-            task = self._queue.get()
-            self._deal_task(task)
+            if task is None:  # 停止信号
+                break
+            if self.batch_size > 1:
+                self._deal_batch(self._get_batch(task))
+            else:
+                self._deal_task(task)
+            self._check_wal()
+            self._report_metrics()
+        self._conn.close()
+        self._queue.close()
+        for reader in self._reader_threads:
+            reader.join()
+        if self._own_executor:
+            self._callback_executor.shutdown()
 
-    def _deal_task(self, task):
+    def _on_idle(self):
+        """
+        队列空闲超时时调用
+        :return:
+        """
+        if self.idle_callback is not None:
+            try:
+                self.idle_callback()
+            except Exception:
+                _logger.exception('Exception in idle callback')
+        if self._wal and self.checkpoint and self._wal_dirty:
+            self._checkpoint('PASSIVE')
+        self._check_wal()
+        self._report_metrics()
+
+    def _check_wal(self):
+        """
+        定时检查WAL文件大小，超过wal_truncate_bytes时截断
+        :return:
+        """
+        if not self._wal or self.wal_truncate_bytes is None:
+            return
+        now = time.monotonic()
+        if now - self._last_wal_check < _WAL_CHECK_INTERVAL:
+            return
+        self._last_wal_check = now
+        db = os.fspath(self._db)  # 也可能是pathlib.Path或bytes
+        if isinstance(db, bytes):
+            db = os.fsdecode(db)
+        if db == ':memory:' or db.startswith('file:'):  # 内存数据库与URI没有对应的WAL文件路径
+            return
+        try:
+            size = os.path.getsize(db + '-wal')
+        except OSError:
+            return
+        if size > self.wal_truncate_bytes:
+            self._checkpoint('TRUNCATE')
+
+    def _checkpoint(self, mode):
+        """
+        执行WAL检查点
+        :param mode: PASSIVE不等待读者，只写回能写回的部分；TRUNCATE等待读者后写回全部并截断WAL文件
+        :return:
+        """
+        try:
+            busy, log, done = self._cursor.execute('PRAGMA wal_checkpoint(%s)' % mode).fetchone()
+        except sqlite3.Error:
+            _logger.exception('Failed to checkpoint WAL')
+            return
+        self._wal_dirty = bool(busy) or done < log  # 有读者时可能只写回一部分
+        with self._stats_lock:
+            self._stats['wal_truncates' if mode == 'TRUNCATE' else 'checkpoints'] += 1
+
+    def _report_metrics(self):
+        """
+        到达间隔时调用metrics_hook
+        :return:
+        """
+        if self.metrics_hook is None or time.monotonic() - self._last_report < self.metrics_interval:
+            return
+        self._last_report = time.monotonic()
+        try:
+            self.metrics_hook(self.stats())
+        except Exception:
+            _logger.exception('Exception in metrics hook')
+
+    def stop(self):
+        """
+        停止工作线程。已注册的任务会先执行完毕
+        :return:
+        """
+        self._queue.put(None)
+        self._read_queue.put(None)
+
+    def stats(self):
+        """
+        取得队列状态，用于判断瓶颈在写线程还是回调
+        :return: dict。queue_depth、read_queue_depth为队列中等待的任务数，worker_busy、reader_busy、callback_busy
+                 分别为写线程、读线程执行SQL和执行回调累计耗时(秒)，tasks、callbacks为已完成的任务数与回调数，
+                 coalesce_hits为合并到已有读任务的任务数，coalesce_merges为被多个任务共享的执行次数，
+                 update_merges为合并到排队中UPDATE的任务数，
+                 cache_hits、cache_misses为结果缓存的命中与未命中次数，lanes、read_lanes为各优先级的排队情况，
+                 queue_bytes、read_queue_bytes为排队任务的估计字节数(仅在设置max_bytes或spill_path时统计)，
+                 spilled为写队列中溢写到磁盘的任务数，checkpoints、wal_truncates为空闲时的检查点与截断WAL的次数，
+                 uptime为创建以来的秒数，throughput为平均每秒完成的任务数，
+                 latency为按语句统计的各阶段耗时(微秒)：queue排队、execute执行、commit提交、callback回调、total从注册到完成(含回调)
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['read_queue_depth'] = self._read_queue.qsize()
+        stats['queue_bytes'] = self._queue.nbytes()
+        stats['read_queue_bytes'] = self._read_queue.nbytes()
+        stats['spilled'] = self._queue.spilled()
+        stats['lanes'] = self._queue.lane_stats()
+        stats['read_lanes'] = self._read_queue.lane_stats()
+        stats['uptime'] = time.monotonic() - self._created
+        stats['throughput'] = stats['tasks'] / stats['uptime'] if stats['uptime'] > 0 else 0.0
+        stats['latency'] = {} if self._metrics is None else self._metrics.snapshot()
+        return stats
+
+    def _add_stats(self, busy_key, busy, tasks):
+        with self._stats_lock:
+            self._stats[busy_key] += busy
+            self._stats['tasks'] += tasks
+
+    def _get_batch(self, first):
+        """
+        从队列中取出一批任务用于组提交
+        :param first: 已取出的第一个任务
+        :return: 任务列表
+        """
+        tasks = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(tasks) < self.batch_size:
+            try:
+                remain = deadline - time.monotonic()
+                if remain > 0:
+                    task = self._queue.get(timeout=remain)
+                else:
+                    task = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:  # 停止信号，执行完本批后退出
+                self._stopping = True
+                break
+            tasks.append(task)
+        return tasks
+
+    def _execute_task(self, task, cursor):
+        """
+        执行任务的SQL语句
+        :param task: 任务
+        :param cursor: 执行所用的cursor
+        :return: 任务结果
+        """
+        if 'updates' in task:  # 合并的UPDATE开始执行后不能再合并
+            self._release_inflight(task)
+        if task['steps'] is not None:
+            return self._execute_steps(task, cursor)
+        if task['cache'] is not None and _has_view(cursor, task['cache'][1]):  # 读视图的结果不缓存
+            task['cache'] = None
         if isinstance(task['data'], tuple):  # 元组即execute
-            self._cursor.execute(task['execute'], task['data'])
+            cursor.execute(task['execute'], task['data'])
         elif isinstance(task['data'], list):  # 列表即executemany
-            self._cursor.executemany(task['execute'], task['data'])
+            cursor.executemany(task['execute'], task['data'])
         else:
-            self._cursor.execute(task['execute'])
-        self._conn.commit()
-        # 取回调函数的参数
-        if task['callback'] is None:
+            cursor.execute(task['execute'])
+        data = None
+        if task['stream'] is not None:  # 流式返回，分批取回数据
+            rows = cursor.fetchmany(task['chunk_size'])
+            while rows and task['stream']._feed(task, rows):
+                rows = cursor.fetchmany(task['chunk_size'])
+        elif task['columnar'] and cursor.description is not None:  # 按列返回
+            data = _fetch_columns(cursor)
+        elif task['fetch']:  # 只有需要时才取回数据
+            data = cursor.fetchall()
+        task['executed'] = time.monotonic()
+        columns = None
+        if data is not None and cursor.description is not None:
+            columns = tuple(d[0] for d in cursor.description)
+        return QueryResult(cursor.lastrowid, data, cursor.rowcount, columns)
+
+    def _execute_steps(self, task, cursor):
+        """
+        依次执行Pipeline的各条语句，参数中对前面语句结果的引用在执行时取值。出错时由调用者回滚整个事务
+        :param task: 任务
+        :param cursor: 执行所用的cursor
+        :return: 任务结果，data为各条语句的QueryResult列表，rowcount为总行数
+        """
+        results = []
+        for execute, data in task['steps']:
+            if isinstance(data, list):
+                cursor.executemany(execute, [_resolve_refs(row, results) for row in data])
+            elif data is not None:
+                cursor.execute(execute, _resolve_refs(data, results))
+            else:
+                cursor.execute(execute)
+            rows = cursor.fetchall()
+            columns = None if cursor.description is None else tuple(d[0] for d in cursor.description)
+            results.append(QueryResult(cursor.lastrowid, rows, cursor.rowcount, columns))
+        task['executed'] = time.monotonic()
+        return QueryResult(results[-1].lst_rowid if results else None, results,
+                           sum(max(result.rowcount, 0) for result in results))
+
+    def _finish_task(self, task, result):
+        """
+        以任务结果完成future并调用回调函数
+        :param task: 任务
+        :param result: 任务结果，执行失败时为异常
+        :return:
+        """
+        if self._metrics is not None and 'executed' in task:
+            self._metrics.record_task(task)
+        if task['stream'] is not None:
+            task['stream']._finish(task, result if isinstance(result, Exception) else None)
+            if not isinstance(result, Exception):
+                self._record_total(task)
+            return
+        if task['cache'] is not None and not isinstance(result, Exception):
+            self._cache.put(*task['cache'], result=result)
+        if task['followers'] is not None:  # 合并执行的任务，结果交给每个注册者
+            self._release_inflight(task)
+            if len(task['followers']) > 1:
+                with self._stats_lock:
+                    self._stats['coalesce_merges'] += 1
+            for follower in task['followers']:
+                if follower['future'] is not None and not follower['future'].set_running_or_notify_cancel():
+                    continue
+                if 'updates' not in task and follower['deadline'] is not None and 'dequeued' in task \
+                        and follower['deadline'] < task['dequeued']:  # 只读任务可以按各自的截止时间丢弃结果
+                    self._finish_task(follower, SqliteQueueTimeout(
+                        'Task expired before execution: %s' % follower['execute']))
+                else:
+                    self._finish_task(follower, result)
             return
-        paras = inspect.getargspec(task['callback'])[0]
-        kwargs = {}
-        for param in paras:
-            if param == 'data':
-                kwargs['data'] = self._cursor.fetchall()
-            elif param == 'rowcount':
-                kwargs['rowcount'] = self._cursor.rowcount
-            elif param == 'lst_rowid':
-                kwargs['lst_rowid'] = self._cursor.lastrowid
+        if isinstance(result, Exception):
+            if task['future'] is not None:
+                task['future'].set_exception(result)
             else:
-                kwargs[param] = None
-        task['callback'](**kwargs)  # 回调
+                _logger.error('Failed to execute task: %s', task['execute'], exc_info=result)
+            return
+        if task['future'] is not None:
+            task['future'].set_result(result)
+        if task['callback'] is None:
+            self._record_total(task)
+            return
+        self._dispatch_callback(task, result, None if self._metrics is None else
+                                functools.partial(self._record_total, task))
 
-    def register_execute(self, execute, data=None, callback=None):
+    def _record_total(self, task):
         """
-        注册一个执行指定SQL命令的操作
+        记录任务从注册到完成(含回调)的耗时
+        :param task: 已完成的任务
+        :return:
+        """
+        if self._metrics is not None and 'registered' in task:
+            self._metrics.record(task['execute'], 'total', time.monotonic() - task['registered'])
+
+    def _release_inflight(self, task):
+        """
+        合并执行的任务不再接受新的注册者
+        :param task: 共享任务
+        :return:
+        """
+        with self._inflight_lock:
+            if self._inflight.get(task['key']) is task:
+                del self._inflight[task['key']]
+
+    def _dispatch_callback(self, task, result, done=None):
+        """
+        按配置在工作线程或callback_executor中调用回调
+        :param task: 任务
+        :param result: 任务结果
+        :param done: 回调结束后调用
+        :return:
+        """
+        if self._callback_executor is None:
+            self._run_callback(task, result, done)
+        elif self.ordered_callbacks:  # 同一注册线程的回调串行执行
+            self._serial_dispatcher.submit(task['thread'], self._run_callback, task, result, done)
+        else:
+            self._callback_executor.submit(self._run_callback, task, result, done)
+
+    def _run_callback(self, task, result, done=None):
+        """
+        调用任务的回调函数
+        :param task: 任务
+        :param result: 任务结果
+        :param done: 回调结束后调用
+        :return:
+        """
+        start = time.monotonic()
+        # 按注册时解析好的参数表取回调函数的参数
+        kwargs = {param: None if index is None else result[index] for param, index in task['plan']}
+        try:
+            task['callback'](**kwargs)  # 回调
+        except Exception:  # 回调出错不应影响工作线程
+            _logger.exception('Exception in callback of task: %s', task['execute'])
+        if done is not None:
+            done()
+        end = time.monotonic()
+        if self._metrics is not None:
+            self._metrics.record(task['execute'], 'callback', end - start)
+        with self._stats_lock:
+            self._stats['callback_busy'] += end - start
+            self._stats['callbacks'] += 1
+
+    def _deal_task(self, task):
+        if task['future'] is not None and not task['future'].set_running_or_notify_cancel():
+            return  # 已被取消
+        start = time.perf_counter()
+        try:
+            # sqlite3模块只为DML隐式开启事务，Pipeline中可能有DDL，显式开启才能整体回滚
+            if task['steps'] is not None and not self._conn.in_transaction:
+                self._cursor.execute('BEGIN')
+            result = self._execute_task(task, self._cursor)
+            self._conn.commit()  # 提交也可能失败，如延迟检查的外键约束、数据库被锁
+        except Exception as e:
+            self._rollback()
+            result = e
+        else:
+            task['committed'] = time.monotonic()
+            self._wal_dirty = True
+            self._invalidate_cache([task])
+        self._add_stats('worker_busy', time.perf_counter() - start, 1)
+        self._finish_task(task, result)
+
+    def _rollback(self):
+        """
+        回滚当前事务，回滚失败时只记录日志，不影响工作线程
+        :return:
+        """
+        try:
+            self._conn.rollback()
+        except sqlite3.Error:
+            _logger.exception('Failed to rollback transaction')
+
+    def _deal_batch(self, tasks):
+        """
+        在一个事务中执行一批任务，只提交一次。每个任务使用独立的savepoint，失败时只回滚该任务
+        :param tasks: 任务列表
+        :return:
+        """
+        tasks = [task for task in tasks
+                 if task['future'] is None or task['future'].set_running_or_notify_cancel()]
+        start = time.perf_counter()
+        results = {}  # id(任务) -> 结果
+        pending = tasks
+        while pending:  # 每轮至少有一个任务得到结果，不会无限重试
+            pending = self._run_batch(pending, results)
+        self._add_stats('worker_busy', time.perf_counter() - start, len(tasks))
+        for task in tasks:
+            self._finish_task(task, results[id(task)])
+
+    def _run_batch(self, tasks, results):
+        """
+        在一个事务中执行任务
+        :param tasks: 任务列表
+        :param results: 保存各任务结果的dict
+        :return: 事务被语句整个回滚(如INSERT OR ROLLBACK)时，需要在新事务中重新执行的任务
+        """
+        executed = []  # 本事务中执行成功的任务
+        retry = []
+        pending = deque(tasks)
+        try:
+            if not self._conn.in_transaction:
+                self._cursor.execute('BEGIN')
+            while pending:
+                task = pending.popleft()
+                self._cursor.execute('SAVEPOINT sqlite_queue_task')
+                try:
+                    results[id(task)] = self._execute_task(task, self._cursor)
+                except Exception as e:
+                    results[id(task)] = e
+                    if not self._conn.in_transaction:  # 之前执行的任务也已回滚，savepoint也不存在了
+                        for done in executed:
+                            if done['stream'] is None:
+                                retry.append(done)
+                            else:  # 流式结果已经交给消费者，不能重新执行
+                                results[id(done)] = SqliteQueueError('Transaction was rolled back by another task!')
+                        executed = []
+                        retry.extend(pending)
+                        break
+                    self._cursor.execute('ROLLBACK TO sqlite_queue_task')
+                else:
+                    executed.append(task)
+                self._cursor.execute('RELEASE sqlite_queue_task')
+            self._conn.commit()
+        except Exception as e:  # 提交失败等，本事务中的任务全部失败
+            self._rollback()
+            executed_ids = {id(task) for task in executed}
+            for task in tasks:
+                if id(task) in executed_ids or id(task) not in results:
+                    results[id(task)] = e
+            return []
+        committed = time.monotonic()
+        self._wal_dirty = True
+        for task in executed:
+            task['committed'] = committed
+        self._invalidate_cache(executed)
+        return retry
+
+    def _deal_read(self, task, conn):
+        """
+        在读连接上执行只读任务
+        :param task: 任务
+        :param conn: 读线程的连接
+        :return:
+        """
+        if task['future'] is not None and not task['future'].set_running_or_notify_cancel():
+            return
+        start = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            result = self._execute_task(task, cursor)
+        except Exception as e:
+            result = e
+        finally:
+            cursor.close()  # 及时结束读事务，避免阻碍WAL检查点
+        self._add_stats('reader_busy', time.perf_counter() - start, 1)
+        self._finish_task(task, result)
+
+    def _expire_task(self, task):
+        """
+        丢弃超过截止时间仍未执行的任务
+        :param task: 任务
+        :return:
+        """
+        if task['future'] is not None and not task['future'].set_running_or_notify_cancel():
+            return
+        self._finish_task(task, SqliteQueueTimeout('Task expired before execution: %s' % task['execute']))
+
+    def _invalidate_cache(self, tasks):
+        """
+        写任务提交后使相关表的缓存失效
+        :param tasks: 已提交的任务
+        :return:
+        """
+        if self._cache is None:
+            return
+        for task in tasks:
+            if task['written'] != frozenset():
+                self._cache.invalidate(task['written'])
+
+    def _register_task(self, execute, data=None, callback=None, future=None, stream=None, chunk_size=None,
+                       cacheable=False, priority=PRIORITY_NORMAL, deadline=None, columnar=False, merge=None,
+                       steps=None, block=None, timeout=None):
+        """
+        检查参数并将任务放入队列
         :param execute: SQL语句
         :param data: 预编译参数
         :param callback: 回调
+        :param future: 任务完成时设置结果的future
+        :param stream: 流式返回时接收每批数据的对象
+        :param chunk_size: 流式返回时每批的行数
+        :param cacheable: 结果是否可以缓存
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param columnar: 是否按列返回结果，见submit_execute
+        :param merge: 可以合并的UPDATE，(表, 更新的数据, 条件字段, 条件值)
+        :param steps: Pipeline的各条语句，(SQL语句, 预编译参数)的列表，在一个事务中依次执行
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
         :return:
         """
         if not isinstance(execute, str):
             raise SqliteQueueError('Illegal param! "execute" must be string!')
         elif data is not None and (not isinstance(data, tuple) and not isinstance(data, list)):
             raise SqliteQueueError('Illegal param! "data" must be tuple or list!')
-        elif callback is not None and str(type(callback)) != "<class 'function'>":
-            raise SqliteQueueError('Illegal param! "callback" must be function!')
-        self._queue.put({
+        elif callback is not None and not callable(callback):
+            raise SqliteQueueError('Illegal param! "callback" must be callable!')
+        elif priority not in (PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK):
+            raise SqliteQueueError('Illegal param! Unknown priority: %s' % priority)
+        plan = () if callback is None else _callback_plan(callback)
+        now = time.monotonic()
+        task = {
             'execute': execute,
             'data': data,
-            'callback': callback
-        })
+            'callback': callback,
+            'future': future,
+            'plan': plan,
+            'thread': threading.get_ident(),
+            'stream': stream,
+            'chunk_size': chunk_size,
+            'fetch': future is not None or any(param == 'data' for param, _ in plan),
+            'columnar': columnar,
+            'steps': steps,
+            'followers': None,
+            'cache': None,
+            'written': frozenset(),
+            'priority': priority,
+            'deadline': None if deadline is None else now + deadline,
+            'size': 0
+        }
+        if self._metrics is not None:
+            task['registered'] = now
+        if self._queue.measured or self._read_queue.measured:
+            task['size'] = _task_size(execute, data) if steps is None else sum(_task_size(*v) for v in steps)
+        read_only = (self.readers > 0 or self.coalesce_reads or self._cache is not None) and steps is None \
+            and _is_read_only(execute)
+        mergeable = merge is not None and self.coalesce_updates and self._spill_path is None and _hashable(merge[3])
+        if not read_only and (self._cache is not None or self.coalesce_reads or self.coalesce_updates):
+            task['written'] = _written_tables(execute) if steps is None else _steps_written(steps)
+            if task['written'] != frozenset():
+                # 写操作注册时先使缓存与合并中的任务失效，保证之后注册的任务不会越过该写操作执行
+                if self._cache is not None:
+                    self._cache.invalidate(task['written'])
+                if (self.coalesce_reads or self.coalesce_updates) and not mergeable:
+                    self._invalidate_inflight(task['written'])
+        # 缓存与合并以(SQL语句, 参数)为键，参数中有bytearray等不可哈希的值时不缓存也不合并
+        shareable = read_only and stream is None and not columnar and not isinstance(data, list) and _hashable(data)
+        if self._cache is not None and shareable and cacheable:
+            if self._cached(task):
+                return
+        # 溢写到磁盘的共享任务不会再更新截止时间，写队列溢写时不合并读任务
+        if self.coalesce_reads and shareable and (self.readers > 0 or self._spill_path is None):
+            task = self._coalesce(task)
+            if task is None:
+                return
+        if mergeable:
+            task = self._merge_update(task, merge)
+            if task is None:
+                return
+        # 工作线程与读线程注册的任务(如在回调中注册)不受队列长度限制，否则可能等待自己
+        current = threading.current_thread()
+        force = current is self or isinstance(current, _SqliteReader)
+        try:
+            if read_only and self.readers > 0:  # 只读语句交给读线程
+                self._read_queue.put(task, force, block, timeout)
+            else:
+                self._queue.put(task, force, block, timeout)
+        except Exception as e:
+            if task['followers'] is not None:  # 共享任务没能入队，已合并进来的其他注册者也要报错
+                self._release_inflight(task)
+                for follower in task['followers'][1:]:
+                    if follower['future'] is None or follower['future'].set_running_or_notify_cancel():
+                        self._finish_task(follower, e)
+            raise
+
+    def _cached(self, task):
+        """
+        查询结果缓存，命中时直接完成任务
+        :param task: 只读任务
+        :return: 是否命中
+        """
+        key = (task['execute'], task['data'])
+        result = self._cache.get(key)
+        with self._stats_lock:
+            self._stats['cache_hits' if result is not None else 'cache_misses'] += 1
+        if result is not None:
+            self._finish_task(task, result)
+            return True
+        tables = _read_tables(task['execute'])
+        if tables:  # 无法解析出表的语句不缓存
+            task['fetch'] = True
+            task['cache'] = (key, tables, self._cache.snapshot(tables))
+        return False
+
+    def _coalesce(self, task):
+        """
+        合并相同的只读任务
+        :param task: 任务
+        :return: 需要放入队列的共享任务，已合并到排队或执行中的任务时返回None
+        """
+        key = (task['execute'], task['data'], task['priority'])
+        with self._inflight_lock:
+            shared = self._inflight.get(key)
+            if shared is not None:
+                shared['followers'].append(task)
+                if shared['deadline'] is not None:  # 截止时间取最晚的，各注册者的截止时间在完成时检查
+                    shared['deadline'] = None if task['deadline'] is None else max(shared['deadline'],
+                                                                                     task['deadline'])
+                with self._stats_lock:
+                    self._stats['coalesce_hits'] += 1
+                return None
+            # 共享任务本身没有回调与future，执行后结果交给所有注册者
+            shared = dict(task, callback=None, future=None, plan=(), fetch=True, followers=[task], key=key,
+                          tables=_read_tables(task['execute']))
+            self._inflight[key] = shared
+        return shared
+
+    def _invalidate_inflight(self, tables, keep=None):
+        """
+        写任务注册后，之后注册的任务不能再合并到之前的任务，否则读不到写入的数据或越过该写任务执行
+        :param tables: 写入的表，None为未知
+        :param keep: 判断合并中的任务是否保留的函数，参数为键与共享任务
+        :return:
+        """
+        with self._inflight_lock:
+            for key, shared in list(self._inflight.items()):
+                if keep is not None and keep(key, shared):
+                    continue
+                # 无法解析出表的读任务总是失效
+                if tables is None or not shared['tables'] or not tables.isdisjoint(shared['tables']):
+                    del self._inflight[key]
+
+    def _merge_update(self, task, merge):
+        """
+        将UPDATE合并到排队中的相同条件的UPDATE
+        :param task: 任务
+        :param merge: (表, 更新的数据, 条件字段, 条件值)
+        :return: 需要放入队列的共享任务，已合并到排队中的任务时返回None
+        """
+        table, updates, column, value = merge
+        key = ('UPDATE', table, column, value, task['priority'])
+
+        def keep(other, shared):
+            # 条件字段相同而取值不同的UPDATE更新的是不同的行，都不修改条件字段时执行顺序不影响结果
+            return other == key or ('updates' in shared and other[1:3] == key[1:3] and
+                                    column not in shared['updates'] and column not in updates)
+
+        self._invalidate_inflight(task['written'], keep)
+        with self._inflight_lock:
+            shared = self._inflight.get(key)
+            if shared is not None:
+                shared['updates'].update(updates)  # 同名字段以后注册的为准
+                shared['execute'], shared['data'] = \
+                    SqlQuery(table, 'UPDATE', shared['updates']).where(column, value).get_sql()
+                shared['followers'].append(task)
+                if shared['deadline'] is not None:  # 截止时间取最晚的
+                    shared['deadline'] = None if task['deadline'] is None else max(shared['deadline'],
+                                                                                     task['deadline'])
+                with self._stats_lock:
+                    self._stats['update_merges'] += 1
+                return None
+            shared = dict(task, callback=None, future=None, plan=(), fetch=True, followers=[task], key=key,
+                          updates=dict(updates), tables=frozenset((table,)))
+            self._inflight[key] = shared
+        return shared
+
+    def register_execute(self, execute, data=None, callback=None, priority=PRIORITY_NORMAL, deadline=None,
+                         columnar=False, block=None, timeout=None):
+        """
+        注册一个执行指定SQL命令的操作
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param callback: 回调
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param columnar: 是否按列返回结果，见submit_execute
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return:
+        """
+        self._register_task(execute, data, callback=callback, priority=priority, deadline=deadline,
+                            columnar=columnar, block=block, timeout=timeout)
+
+    def submit_execute(self, execute, data=None, priority=PRIORITY_NORMAL, deadline=None, columnar=False,
+                       block=None, timeout=None):
+        """
+        注册一个执行指定SQL命令的操作，返回future
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param columnar: 是否按列返回结果。是则data为字段名到数组的dict，安装了numpy时为numpy数组，
+                         否则整数与浮点数列为array.array，其他列为list。结果分批取回，不保留每行的元组
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return: concurrent.futures.Future，结果为QueryResult，执行出错时设置异常
+        """
+        future = Future()
+        self._register_task(execute, data, future=future, priority=priority, deadline=deadline, columnar=columnar,
+                            block=block, timeout=timeout)
+        return future
+
+    def _register_group(self, sqls, callback=None, priority=PRIORITY_NORMAL, deadline=None, block=None,
+                        timeout=None):
+        """
+        注册多条语句，全部完成后只回调一次
+        :param sqls: (SQL语句, 预编译参数)的列表
+        :param callback: 回调，lst_rowid为最后一条语句的结果，rowcount为总行数
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return:
+        """
+        if callback is not None and not callable(callback):
+            raise SqliteQueueError('Illegal param! "callback" must be callable!')
+        combined = _combine_futures([self.submit_execute(*v, priority=priority, deadline=deadline, block=block,
+                                                         timeout=timeout) for v in sqls])
+        self._callback_on(combined, callback, sqls[-1][0])
+
+    def _callback_on(self, future, callback, execute):
+        """
+        future完成时调用回调，与普通任务一样按callback_executor的设置执行
+        :param future: 合并多个任务结果的future
+        :param callback: 回调，可以为None
+        :param execute: 出错时日志中记录的SQL语句
+        :return:
+        """
+        if callback is None:
+            return
+        task = {'execute': execute, 'callback': callback, 'plan': _callback_plan(callback),
+                'thread': threading.get_ident()}
+
+        def done(combined):
+            if combined.exception() is not None:
+                _logger.error('Failed to execute task: %s', task['execute'], exc_info=combined.exception())
+            else:
+                self._dispatch_callback(task, combined.result())
+
+        future.add_done_callback(done)
+
+    def pipeline(self):
+        """
+        创建Pipeline，多条语句作为一个任务在一个事务中执行
+        :return:
+        """
+        return Pipeline(self)
+
+    def stream_execute(self, execute, data=None, chunk_size=1000, callback=None, buffer=4, priority=PRIORITY_NORMAL,
+                       deadline=None):
+        """
+        注册一个流式返回结果的操作，结果以fetchmany分批返回，执行线程不会持有完整结果
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param chunk_size: 每批的行数
+        :param callback: 每批数据调用一次的回调，data为该批数据。为None时返回ResultStream
+        :param buffer: 最多缓冲的批数，消费跟不上时执行线程会等待
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :return: 无回调时返回ResultStream，可迭代得到每批数据
+        """
+        if callback is None:
+            stream = ResultStream(buffer)
+            self._register_task(execute, data, stream=stream._channel, chunk_size=chunk_size, priority=priority,
+                                deadline=deadline)
+            return stream
+        self._register_task(execute, data, callback=callback, stream=_CallbackStream(self, buffer),
+                            chunk_size=chunk_size, priority=priority, deadline=deadline)
 
-    def register_peewee_query(self, pw_query, callback=None):
+    def register_peewee_query(self, pw_query, callback=None, priority=PRIORITY_NORMAL, deadline=None):
         """
         注册一个执行peewee查询的操作
         :param pw_query: peewee查询对象
         :param callback: 回调
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
         :return:
         """
-        if not __peewee__:
-            raise SqliteQueueError('Module "peewee" have not been installed.')
-        if not isinstance(pw_query, peewee.Query):
-            raise SqliteQueueError('Illegal param! "pw_query" must be peewee.Query!')
-        sql = pw_query.sql()
-        self.register_execute(sql[0], tuple(sql[1]), callback=callback)
+        sql = _peewee_sql(pw_query)
+        self.register_execute(sql[0], tuple(sql[1]), callback=callback, priority=priority, deadline=deadline)
+
+    def submit_peewee_query(self, pw_query, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        注册一个执行peewee查询的操作，返回future
+        :param pw_query: peewee查询对象
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :return: concurrent.futures.Future，结果为QueryResult
+        """
+        sql = _peewee_sql(pw_query)
+        return self.submit_execute(sql[0], tuple(sql[1]), priority=priority, deadline=deadline)
 
     def select(self, table):
         """
@@ -143,7 +1011,7 @@ class SqliteQueue(threading.Thread):
         :param table: 目标表
         :return:
         """
-        return SqlQuery(table, method='UPDATE', obj_queue=self)
+        return SqlQuery(table, method='DELETE', obj_queue=self)
 
     def drop(self, table):
         """
@@ -163,322 +1031,2362 @@ class SqliteQueue(threading.Thread):
         return SqlQuery(table, method='CREATE', params=params, obj_queue=self)
 
 
-class SqlQuery:
+class _SerialDispatcher:
     """
-    简单的sql命令封装
+    按key串行地将函数交给executor执行，同一key的函数按提交顺序依次执行
     """
 
-    def __init__(self, table, method='SELECT', params=None, obj_queue=None):
-        self._queue = obj_queue
-        self._sql = {'table': table, 'method': method, 'distinct': False}
-        self._params = params
-        self._data = None
+    def __init__(self, executor):
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> 等待执行的函数
 
-    def execute(self, command, data=None):
-        self._sql = command
-        self._data = data
-        return self
+    def submit(self, key, fn, *args):
+        with self._lock:
+            if key in self._pending:  # 该key正在执行，排队等候
+                self._pending[key].append((fn, args))
+                return
+            self._pending[key] = deque()
+        self._executor.submit(self._run, key, fn, args)
 
-    def _has_commanded(self):
+    def _run(self, key, fn, args):
+        while True:
+            fn(*args)
+            with self._lock:
+                if not self._pending[key]:
+                    del self._pending[key]
+                    return
+                fn, args = self._pending[key].popleft()
+
+
+class _TaskScheduler:
+    """
+    分优先级的任务队列。各优先级按权重轮流出队，避免低优先级饿死；超过截止时间的任务在出队时丢弃。
+    可以限制任务数与参数占用的字节数，队列满时放入任务会等待或报错
+    """
+
+    def __init__(self, expire, maxsize=0, max_bytes=0, put_timeout=None, high_watermark=None, low_watermark=None,
+                 on_high_watermark=None, on_low_watermark=None, spill_path=None, spill_bytes=0, recover_spill=False):
         """
-        检查是否执行过execute方法
-        :return:
+        :param expire: 丢弃超时任务时调用
+        其余参数见SqliteQueue
         """
-        if isinstance(self._sql, str):
-            raise Exception('This method cannot be invoked after using method "execute"!')
+        self._expire = expire
+        self._maxsize = maxsize
+        self._max_bytes = max_bytes
+        self._put_timeout = put_timeout
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark if low_watermark is not None else high_watermark
+        self._on_high_watermark = on_high_watermark
+        self._on_low_watermark = on_low_watermark
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._lanes = [deque() for _ in _LANE_NAMES]
+        self._credits = list(_LANE_WEIGHTS)
+        self._count = 0
+        self._bytes = 0
+        self._above_high = False
+        self._stopped = False
+        self._waits = [[0, 0.0, 0.0, 0] for _ in _LANE_NAMES]  # 出队数、总等待时间、最长等待时间、丢弃数
+        self._spill_bytes = spill_bytes
+        self._mem_bytes = 0  # 内存中任务的字节数，超过spill_bytes后溢写到磁盘
+        self._spilled = [0 for _ in _LANE_NAMES]  # 各优先级在磁盘中尚未读回的任务数
+        self._handles = {}  # 溢写序号 -> 留在内存中的回调、future等
+        self._spool = None
+        if spill_path is not None:
+            self._spool = _TaskSpool(spill_path, recover_spill)
+            for lane, count, size in self._spool.recovered():
+                self._spilled[lane] = count
+                self._count += count
+                self._bytes += size
 
-    def table(self, table):
+    @property
+    def measured(self):
         """
-        设定操作的目标表
-        :param table:
-        :return:
+        :return: 是否需要估计任务的字节数
         """
-        self._has_commanded()
-        self._sql['table'] = table
-        return self
+        return self._max_bytes > 0 or self._spool is not None
 
-    def field(self, *args):
+    def _full(self, size):
+        if self._maxsize > 0 and self._count >= self._maxsize:
+            return True
+        # 单个任务超过字节限制时，队列空了也允许放入
+        return self._max_bytes > 0 and self._count > 0 and self._bytes + size > self._max_bytes
+
+    def put(self, task, force=False, block=None, timeout=None):
         """
-        表示操作对象的字段
-        :param args:
+        放入任务，None为停止信号，队列中的任务全部出队后get返回None
+        :param task: 任务
+        :param force: 忽略队列长度限制，用于工作线程自身注册的任务，避免等待自己
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，None则一直等待
         :return:
         """
-        self._has_commanded()
-        result = ''
-        if len(args) < 1:
-            raise ValueError('Method "field" needs at least one param!')
-        elif len(args) == 1:
-            args = args[0]
-            if isinstance(args, str):  # 若为字符串，则视为直接输入SQL格式
-                result = args + ' '  # 空格占位哈哈哈哈，我有毒
-            elif isinstance(args, dict):  # 若为字典，则可能有as
-                if len(args) < 1:
-                    raise ValueError('Illegal length of param for method "field"!')
-                for k, v in args.items():
-                    if v is None:
-                        result += '`%s`,' % str(k)
-                    else:
-                        result += '`%s` AS %s,' % (str(k), str(v))
+        hook = None
+        with self._lock:
+            if task is None:
+                self._stopped = True
+                self._not_empty.notify_all()
+                return
+            if not force and self._full(task['size']):
+                if block is None:
+                    block = self._put_timeout is None or self._put_timeout > 0
+                    timeout = self._put_timeout
+                if not block:
+                    raise SqliteQueueFull('Task queue is full!')
+                end = None if timeout is None else time.monotonic() + timeout
+                while self._full(task['size']):
+                    remain = None if end is None else end - time.monotonic()
+                    if remain is not None and remain <= 0:
+                        raise SqliteQueueFull('Task queue is full!')
+                    self._not_full.wait(remain)
+            task['enqueued'] = time.monotonic()
+            lane = task['priority']
+            # 该优先级已有任务在磁盘中时也写入磁盘，保证按注册顺序执行
+            if self._spool is not None and (self._spilled[lane] or
+                                            self._mem_bytes + task['size'] > self._spill_bytes):
+                self._spill(task)
             else:
-                raise ValueError('Illegal param for method "field"!')
-        else:
-            for v in args:  # 直接拼接即可
-                result += '`%s`,' % str(v)
-        self._sql['field'] = result[:-1]
-        return self
+                self._lanes[lane].append(task)
+                self._mem_bytes += task['size']
+            self._count += 1
+            self._bytes += task['size']
+            self._not_empty.notify()
+            if self._high_watermark is not None and not self._above_high and self._count >= self._high_watermark:
+                self._above_high = True
+                hook = self._on_high_watermark
+            depth = self._count
+        if hook is not None:
+            self._call_hook(hook, depth)
 
-    def where(self, *args):
+    def get(self, block=True, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            hook = None
+            with self._lock:
+                while not self._count:
+                    if self._stopped:
+                        return None
+                    remain = None if end is None else end - time.monotonic()
+                    if not block or (remain is not None and remain <= 0):
+                        raise queue.Empty
+                    self._not_empty.wait(remain)
+                task = self._pop()
+                self._count -= 1
+                self._bytes -= task['size']
+                self._mem_bytes -= task['size']
+                if 'spill_seq' in task:  # 出队后才从磁盘删除
+                    self._spool.remove(task.pop('spill_seq'))
+                self._not_full.notify_all()
+                if self._above_high and self._count <= self._low_watermark:
+                    self._above_high = False
+                    hook = self._on_low_watermark
+                depth = self._count
+                now = task['dequeued'] = time.monotonic()
+                wait = self._waits[task['priority']]
+                expired = task['deadline'] is not None and task['deadline'] < now
+                if not expired:
+                    wait[0] += 1
+                    wait[1] += now - task['enqueued']
+                    wait[2] = max(wait[2], now - task['enqueued'])
+                else:
+                    wait[3] += 1
+            if hook is not None:
+                self._call_hook(hook, depth)
+            if not expired:
+                return task
+            self._expire(task)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    @staticmethod
+    def _call_hook(hook, depth):
         """
-        设置where条件，重复调用会叠加并使用AND连接
-        :param args:
+        调用水位回调，回调出错不影响放入任务的线程与工作线程
+        :param hook: on_high_watermark或on_low_watermark
+        :param depth: 当前任务数
         :return:
         """
-        self._has_commanded()
-        cond = _parse_condition(*args)
-        if 'where' in self._sql:  # 已经存在where了，拼接之
-            self._sql['where'][0] += ' AND ' + cond[0]  # 拼接条件语句
-            self._sql['where'][1] += cond[1]  # 拼接参数
-        else:
-            self._sql['where'] = cond
-        return self
+        try:
+            hook(depth)
+        except Exception:
+            _logger.exception('Exception in watermark hook')
 
-    def or_where(self, *args):
+    def _pop(self):
         """
-        设置where条件，重复调用会叠加并使用OR连接
-        :param args:
+        按权重轮流从各优先级取出任务
         :return:
         """
-        self._has_commanded()
-        if 'where' in self._sql:  # 已经存在where了，拼接之
-            cond = _parse_condition(*args)
-            self._sql['where'][0] += ' OR ' + cond[0]  # 拼接条件语句
-            self._sql['where'][1] += cond[1]  # 拼接参数
-        else:  # 不存在和where方法相同
-            self.where(*args)
-        return self
+        for _ in range(2):
+            for lane, tasks in enumerate(self._lanes):
+                if self._credits[lane] <= 0:
+                    continue
+                if not tasks and self._spilled[lane] and self._spool is not None:
+                    self._load(lane)
+                if tasks:
+                    self._credits[lane] -= 1
+                    return tasks.popleft()
+            self._credits = list(_LANE_WEIGHTS)  # 有任务的优先级都用完了份额，开始新一轮
 
-    def order(self, *args):
+    def _spill(self, task):
         """
-        设置排序字段
-        :param args:
+        将任务写入磁盘。SQL与参数写入磁盘，回调、future等无法序列化的部分留在内存中
+        :param task: 任务
         :return:
         """
-        self._has_commanded()
-        result = ''
-        if len(args) < 1:
-            raise ValueError('Method "order" needs at least one param!')
-        elif len(args) == 1 and _is_sql(args[0]):  # SQL格式
-            self._sql['order'] = args[0]
-            return self
-        elif isinstance(args[0], dict):  # 含排序方式
-            for k, v in args[0].items():
-                if v is None:
-                    result += '`%s`,' % str(k)
-                else:
-                    result += '`%s` %s,' % (str(k), str(v))
-        else:
-            for v in args:
-                result += '`%s`,' % str(v)
-        self._sql['order'] = result[:-1]
-        return self
+        record = {key: value for key, value in task.items() if key not in _SPILL_LOCAL}
+        seq = self._spool.push(task['priority'], record)
+        if task['callback'] is not None or task['future'] is not None or task['stream'] is not None \
+                or task['followers']:
+            self._handles[seq] = {key: task[key] for key in _SPILL_LOCAL}
+        self._spilled[task['priority']] += 1
 
-    def group(self, *args):
+    def _load(self, lane):
         """
-        设置结果分组(GROUP BY)
-        :param args:
+        从磁盘按顺序读回一批任务
+        :param lane: 优先级
         :return:
         """
-        self._has_commanded()
-        result = ''
-        if len(args) < 1:
-            raise ValueError('Method "order" needs at least one param!')
-        elif len(args) == 1 and _is_sql(args[0]):  # SQL格式
-            self._sql['group'] = args[0]
-            return self
-        else:
-            for v in args:
-                result += '`%s`,' % str(v)
-        self._sql['group'] = result[:-1]
-        return self
+        for seq, record in self._spool.load(lane, _SPILL_LOAD):
+            local = self._handles.pop(seq, None)
+            if local is None:  # 没有回调的任务，或恢复出的任务
+                local = {'callback': None, 'future': None, 'plan': (), 'thread': None, 'stream': None,
+                         'followers': None}
+            record.update(local)
+            record['spill_seq'] = seq
+            self._lanes[lane].append(record)
+            self._mem_bytes += record['size']
+            self._spilled[lane] -= 1
 
-    def limit(self, start, num):
+    def spilled(self):
         """
-        设置返回条数限制
-        :param start: 开始位置
-        :param num: 返回条数
+        :return: 磁盘中的任务数
+        """
+        with self._lock:
+            return sum(self._spilled)
+
+    def close(self):
+        """
+        关闭溢写文件，未执行的任务保留在文件中
         :return:
         """
-        self._has_commanded()
-        # 参数检查
-        if int(start) < 0:
-            raise ValueError('The value of param "start" must be positive number!')
-        if int(num) < 1:
-            raise ValueError('The value of param "num" must bigger than zero!')
-        self._sql['limit'] = ['?,?', [start, num]]
-        return self
+        with self._lock:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
 
-    def page(self, index, num):
+    def qsize(self):
+        with self._lock:
+            return self._count
+
+    def nbytes(self):
         """
-        返回结果分页
-        :param index: 页码，1开始
-        :param num: 单页结果数
+        :return: 排队任务的估计字节数，仅在限制字节数时统计
+        """
+        with self._lock:
+            return self._bytes
+
+    def lane_stats(self):
+        """
+        :return: 各优先级的排队数、出队数、平均与最长等待时间(秒)、超时丢弃数
+        """
+        with self._lock:
+            return {name: {'depth': len(self._lanes[lane]), 'dequeued': wait[0],
+                           'wait_avg': wait[1] / wait[0] if wait[0] else 0.0, 'wait_max': wait[2],
+                           'expired': wait[3]}
+                    for lane, (name, wait) in enumerate(zip(_LANE_NAMES, self._waits))}
+
+
+class _TaskSpool:
+    """
+    溢写到磁盘的任务，保存在单独的sqlite文件中，由调度器加锁访问
+    """
+
+    def __init__(self, path, recover=False):
+        """
+        :param path: 溢写文件
+        :param recover: 是否保留文件中上次未执行的任务
+        """
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')  # WAL模式下提交不等待刷盘，进程崩溃不丢数据
+        # AUTOINCREMENT保证删除后序号也不会重复使用，读回时按序号判断哪些任务已在内存中
+        self._conn.execute('CREATE TABLE IF NOT EXISTS spool(seq INTEGER PRIMARY KEY AUTOINCREMENT, lane INTEGER, '
+                           'size INTEGER, task BLOB)')
+        if not recover:
+            self._conn.execute('DELETE FROM spool')
+        # 序号不超过该值的任务是上次运行留下的
+        self._recover_seq = self._conn.execute('SELECT IFNULL(MAX(seq), 0) FROM spool').fetchone()[0]
+        self._loaded = {}  # 优先级 -> 已读回内存的最大序号
+
+    def recovered(self):
+        """
+        :return: 文件中已有的任务，(优先级, 任务数, 字节数)的列表
+        """
+        return self._conn.execute('SELECT lane, COUNT(*), SUM(size) FROM spool GROUP BY lane').fetchall()
+
+    def push(self, lane, record):
+        """
+        :param lane: 优先级
+        :param record: 可序列化的任务内容
+        :return: 序号
+        """
+        try:
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:  # 如参数中有memoryview
+            raise SqliteQueueError('Illegal param! Cannot spill "data": %s' % e)
+        return self._conn.execute('INSERT INTO spool(lane, size, task) VALUES (?, ?, ?)',
+                                  (lane, record['size'], data)).lastrowid
+
+    def load(self, lane, limit):
+        """
+        按写入顺序读出任务，不删除
+        :param lane: 优先级
+        :param limit: 最多读出的任务数
+        :return: (序号, 任务内容)的列表
+        """
+        rows = self._conn.execute('SELECT seq, task FROM spool WHERE lane = ? AND seq > ? ORDER BY seq LIMIT ?',
+                                  (lane, self._loaded.get(lane, 0), limit)).fetchall()
+        now = time.monotonic()
+        records = []
+        for seq, data in rows:
+            record = pickle.loads(data)
+            if seq <= self._recover_seq:  # 上次运行留下的任务，时间已无意义
+                record['deadline'] = None
+                record['enqueued'] = now
+                if 'registered' in record:
+                    record['registered'] = now
+            records.append((seq, record))
+        if rows:
+            self._loaded[lane] = rows[-1][0]
+        return records
+
+    def remove(self, seq):
+        self._conn.execute('DELETE FROM spool WHERE seq = ?', (seq,))
+
+    def close(self):
+        self._conn.close()
+
+
+class _Histogram:
+    """
+    按2的幂分桶的耗时直方图，单位微秒
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * 40
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        self.buckets[min(int(us).bit_length(), 39)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        """
+        :param p: 百分位，0~1
+        :return: 所在桶的上界
+        """
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return min(float(1 << i), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99), 'p999': self.percentile(0.999),
+                'max': self.max}
+
+
+class _Metrics:
+    """
+    按语句(去除字面量后的SQL)统计各阶段耗时
+    """
+    max_shapes = 1000  # 语句种类过多时，其余的统计到'other'中
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shapes = {}  # 语句 -> {阶段: _Histogram}
+
+    def _phases(self, sql):
+        """
+        取得语句的各阶段直方图，需持有锁
+        :param sql: SQL语句
         :return:
         """
-        self.limit((int(index) - 1) * int(num), int(num))
-        return self
+        shape = _normalize_sql(sql)
+        phases = self._shapes.get(shape)
+        if phases is None:
+            if len(self._shapes) >= self.max_shapes:
+                shape = 'other'
+            phases = self._shapes.setdefault(shape, {phase: _Histogram() for phase in _PHASES})
+        return phases
 
-    def having(self, *args):
+    def record(self, sql, phase, seconds):
+        with self._lock:
+            self._phases(sql)[phase].add(seconds)
+
+    def record_task(self, task):
         """
-        设置having条件，重复调用会叠加并使用AND连接
-        :param args:
+        由任务的时间戳记录排队、执行与提交耗时，总耗时在回调结束后另外记录
+        :param task: 已执行的任务
         :return:
         """
-        self._has_commanded()
-        cond = _parse_condition(*args)
-        if 'having' in self._sql:  # 已经存在where了，拼接之
-            self._sql['having'][0] += ' AND ' + cond[0]  # 拼接条件语句
-            self._sql['having'][1] += cond[1]  # 拼接参数
-        else:
-            self._sql['having'] = cond
-        return self
+        if 'enqueued' not in task:
+            return
+        with self._lock:
+            phases = self._phases(task['execute'])
+            phases['queue'].add(task['dequeued'] - task['enqueued'])
+            phases['execute'].add(task['executed'] - task['dequeued'])
+            if 'committed' in task:
+                phases['commit'].add(task['committed'] - task['executed'])
 
-    def or_having(self, *args):
+    def snapshot(self):
+        with self._lock:
+            return {shape: {phase: histogram.snapshot() for phase, histogram in phases.items() if histogram.count}
+                    for shape, phases in self._shapes.items()}
+
+
+class _ResultCache:
+    """
+    LRU结果缓存。每张表有一个版本号，表被写入时版本号增加并删除相关的缓存
+    """
+
+    def __init__(self, size, ttl=None):
+        self._size = size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (过期时间, 表, 结果)
+        self._versions = {}  # 表 -> 版本号
+        self._version = 0  # 全部表的版本号
+
+    def snapshot(self, tables):
         """
-        设置having条件，重复调用会叠加并使用OR连接
-        :param args:
+        取得表的当前版本，执行期间表被写入的结果不会存入缓存
+        :param tables: 表名
         :return:
         """
-        self._has_commanded()
-        if 'having' in self._sql:  # 已经存在where了，拼接之
-            cond = _parse_condition(*args)
-            self._sql['having'][0] += ' OR ' + cond[0]  # 拼接条件语句
-            self._sql['having'][1] += cond[1]  # 拼接参数
-        else:  # 不存在和where方法相同
-            self.having(*args)
-        return self
+        with self._lock:
+            return self._version, tuple(self._versions.get(table, 0) for table in tables)
 
-    def distinct(self, is_distinct):
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():  # 已过期
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return entry[2]._replace(data=list(entry[2].data))  # 每次命中返回新的列表，调用者修改不影响缓存
+
+    def put(self, key, tables, snapshot, result):
+        expire = None if self._ttl is None else time.monotonic() + self._ttl
+        with self._lock:
+            if snapshot != (self._version, tuple(self._versions.get(table, 0) for table in tables)):
+                return  # 执行期间表已被写入
+            self._entries[key] = (expire, tables, result._replace(data=tuple(result.data)))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tables=None):
         """
-        设置是否返回重复值
-        :param is_distinct: 是否返回重复值
-        :type is_distinct: bool
+        使表的缓存失效
+        :param tables: 表名，None则全部失效
         :return:
         """
-        self._has_commanded()
-        self._sql['distinct'] = bool(is_distinct)
-        return self
+        with self._lock:
+            if tables is None:
+                self._version += 1
+                self._entries.clear()
+                return
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+            for key in [k for k, v in self._entries.items() if not tables.isdisjoint(v[1])]:
+                del self._entries[key]
 
-    def data(self, data):
+
+class _StreamChannel:
+    """
+    ResultStream与执行线程之间的缓冲区。执行线程只引用该对象，因此ResultStream没有关闭就被丢弃时仍能被回收
+    """
+
+    def __init__(self, buffer):
+        self._chunks = queue.Queue(max(1, buffer))
+        self._closed = False
+
+    def _feed(self, task, chunk):
         """
-        增加命令所需数据。如INSERT, UPDATE。
-        :param data:
+        执行线程放入一批数据
+        :param task: 任务
+        :param chunk: 数据
+        :return: 是否继续
+        """
+        while not self._closed:
+            try:
+                self._chunks.put(chunk, timeout=0.1)
+                return True
+            except queue.Full:  # 等待消费，期间检查是否已被关闭
+                continue
+        return False
+
+    def _finish(self, task, error=None):
+        """
+        执行线程结束数据流
+        :param task: 任务
+        :param error: 执行出错时的异常
         :return:
         """
-        self._params = data
+        self._feed(task, (error,))
+
+    def close(self):
+        self._closed = True
+
+
+class ResultStream:
+    """
+    流式结果。迭代(或async for)得到每批数据，缓冲区满时执行线程会等待消费。不再需要时应调用close，
+    没有关闭就被回收时也会关闭
+    """
+
+    def __init__(self, buffer=4):
+        self._channel = _StreamChannel(buffer)
+        self._done = False
+        weakref.finalize(self, self._channel.close)  # 否则执行线程会一直等待消费
+
+    def _next_chunk(self):
+        if self._done:
+            return None
+        chunk = self._channel._chunks.get()
+        if isinstance(chunk, tuple):  # 结束标志
+            self._done = True
+            if chunk[0] is not None:
+                raise chunk[0]
+            return None
+        return chunk
+
+    def __iter__(self):
         return self
 
-    def get_sql(self):
+    def __next__(self):
+        chunk = self._next_chunk()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await asyncio.get_running_loop().run_in_executor(None, self._next_chunk)
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def rows(self):
         """
-        生成sql语句
-        :return: 元组，若长度为2则包含参数
+        逐行迭代
+        :return:
         """
-        if isinstance(self._sql, str):
-            if self._data is None:
-                return self._sql,
-            else:
-                return self._sql, self._data
-        method = self._sql['method'].upper()
-        # select语句顺序: SELECT-field-from-where-order-group-limit-having
-        if method == 'SELECT':  # 生成SELECT语句
-            if 'field' not in self._sql:
-                field = '*'
-            else:
-                field = self._sql['field']
-            if self._sql['distinct']:
-                distinct = 'DISTINCT '
-            else:
-                distinct = ''
-            sql = 'SELECT %s%s FROM %s' % (distinct, field, self._sql['table'])
-            data = []
-            if 'where' in self._sql:
-                sql += ' WHERE ' + self._sql['where'][0]
-                data += self._sql['where'][1]
-            if 'order' in self._sql:
-                sql += ' ORDER BY ' + self._sql['order']
-            if 'group' in self._sql:
-                sql += ' GROUP BY ' + self._sql['group']
-            if 'limit' in self._sql:
-                sql += ' LIMIT ' + self._sql['limit'][0]
-                data += self._sql['limit'][1]
-            if 'having' in self._sql:
-                sql += ' HAVING ' + self._sql['having'][0]
-                data += self._sql['having'][1]
-            return sql, tuple(data)
-        elif method == 'INSERT':  # 生成INSERT语句
-            if isinstance(self._params, dict) and len(self._params) > 0:
-                dic = [self._params]
-            elif isinstance(self._params, list) and len(self._params) > 0:
-                dic = self._params
-            else:
-                raise ValueError('Illegal value for param!')
-            result = []
-            for v in dic:
-                sql = 'INSERT INTO %s (' % self._sql['table']
-                for k in v.keys():
-                    sql += '`%s`,' % k
-                sql = sql[:-1] + ') VALUES (' + ('?,' * len(v))[:-1] + ')'
-                result.append((sql, tuple(v.values())))
-            return result
-        elif method == 'UPDATE':  # 生成UPDATE语句
-            if not isinstance(self._params, dict) or len(self._params) < 1:
-                raise ValueError('Illegal value for param!')
-            sql = 'UPDATE %s SET ' % self._sql['table']
-            data = []
-            for k in self._params.keys():
-                sql += '`%s`=?,' % k
-            sql = sql[:-1]  # 去除多余逗号
-            data += self._params.values()
-            if 'where' in self._sql:
-                sql += ' WHERE ' + self._sql['where'][0]
-                data += self._sql['where'][1]
-            return sql, tuple(data)
-        elif method == 'DELETE':  # 生成DELETE语句
-            sql = 'DELETE FROM %s' % self._sql['table']
-            data = []
-            if 'where' in self._sql:
-                sql += ' WHERE ' + self._sql['where'][0]
-                data += self._sql['where'][1]
-            return sql, tuple(data)
-        elif method == 'TRUNCATE':
-            raise Exception('Method "TRUNCATE" wasn\'t support in sqlite!')
-        elif method == 'DROP':  # 生成DROP语句
-            return 'DROP TABLE ' + self._sql['table'],
-        elif method == 'CREATE':
-            sql = 'CREATE TABLE `%s`(' % self._sql['table']
-            for k, v in self._params.items():
-                sql += '%s %s,' % (k, v)
-            return sql[:-1] + ')',
-        else:
-            raise Exception("Unknown method %s!" % method)
+        for chunk in self:
+            yield from chunk
 
-    def register(self, callback=None):
+    def close(self):
         """
-        注册为SqliteQueue的任务
-        :param callback: 回调函数
+        停止接收数据，执行线程会放弃剩余结果
         :return:
         """
-        if self._queue is None or not isinstance(self._queue, SqliteQueue):
-            raise Exception("This object wasn't belong to a SqliteQueue!")
-        sql = self.get_sql()
-        if not isinstance(sql, list):
-            sql = [sql]
-        for v in sql:
-            self._queue.register_execute(*v, callback=callback)
+        self._channel.close()
+        self._done = True
+
+    def __enter__(self):
         return self
 
+    def __exit__(self, *args):
+        self.close()
 
-class SqliteQueueError(Exception):
-    pass
+
+class _CallbackStream:
+    """
+    流式结果，每批数据调用一次回调。最多buffer批数据等待回调
+    """
+
+    def __init__(self, obj_queue, buffer=4):
+        self._queue = obj_queue
+        self._slots = threading.Semaphore(max(1, buffer))
+
+    def _feed(self, task, chunk):
+        self._slots.acquire()  # 回调跟不上时等待
+        self._queue._dispatch_callback(task, QueryResult(None, chunk, len(chunk)), self._slots.release)
+        return True
+
+    def _finish(self, task, error=None):
+        if error is not None:
+            _logger.error('Failed to execute task: %s', task['execute'], exc_info=error)
+
+
+class _SqliteReader(threading.Thread):
+    """
+    读线程，持有一个只读连接并执行SqliteQueue分发的只读任务
+    """
+
+    def __init__(self, obj_queue):
+        threading.Thread.__init__(self)
+        self.daemon = obj_queue.daemon
+        self._queue = obj_queue
+
+    def run(self):
+        conn = sqlite3.connect(self._queue._db)
+        conn.execute('PRAGMA query_only=ON')  # 保险起见，误判的写语句会直接报错
+        for name, value in self._queue.pragmas.items():
+            if name in _CONNECTION_PRAGMAS:
+                conn.execute('PRAGMA %s=%s' % (name, value))
+        while True:
+            task = self._queue._read_queue.get()
+            if task is None:  # 停止信号
+                break
+            self._queue._deal_read(task, conn)
+        conn.close()
+
+
+class AsyncSqliteQueue:
+    """
+    SqliteQueue的asyncio封装。任务仍由SqliteQueue的工作线程执行，结果交回事件循环
+    """
+
+    def __init__(self, obj_queue):
+        """
+        :param obj_queue: SqliteQueue对象
+        """
+        if not isinstance(obj_queue, SqliteQueue):
+            raise SqliteQueueError('Illegal param! "obj_queue" must be SqliteQueue!')
+        self.queue = obj_queue
+
+    async def execute(self, execute, data=None):
+        """
+        执行指定SQL命令
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :return: QueryResult
+        """
+        return await asyncio.wrap_future(self.queue.submit_execute(execute, data))
+
+    async def peewee_query(self, pw_query):
+        """
+        执行peewee查询
+        :param pw_query: peewee查询对象
+        :return: QueryResult
+        """
+        return await asyncio.wrap_future(self.queue.submit_peewee_query(pw_query))
+
+    def stream(self, execute, data=None, chunk_size=1000, buffer=4):
+        """
+        流式执行指定SQL命令
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param chunk_size: 每批的行数
+        :param buffer: 最多缓冲的批数
+        :return: ResultStream，使用async for得到每批数据
+        """
+        return self.queue.stream_execute(execute, data, chunk_size, buffer=buffer)
+
+    def select(self, table):
+        return self.queue.select(table)
+
+    def insert(self, table, data=None):
+        return self.queue.insert(table, data)
+
+    def update(self, table, data=None):
+        return self.queue.update(table, data)
+
+    def delete(self, table):
+        return self.queue.delete(table)
+
+    def drop(self, table):
+        return self.queue.drop(table)
+
+    def create(self, table, params=None):
+        return self.queue.create(table, params)
+
+
+class SqliteQueueServer(threading.Thread):
+    """
+    让其他进程通过本地连接(Unix socket、命名管道等)向同一个SqliteQueue提交任务，避免多个进程争抢数据库文件锁。
+    SQL与参数以marshal编码传输，结果在执行完成后按完成顺序返回，客户端可以同时有多个请求在执行。
+    连上的客户端可以执行任意SQL，且marshal不能安全地解码不可信的数据，只应让可信的进程连接
+    """
+
+    def __init__(self, obj_queue, address, authkey=None, family=None):
+        """
+        :param obj_queue: 执行任务的SqliteQueue对象
+        :param address: 监听地址，如Unix socket路径、('127.0.0.1', 端口)，见multiprocessing.connection.Listener
+        :param authkey: 连接认证的密钥(bytes)，只有Unix socket可以为None即不认证，此时由文件权限限制访问
+        :param family: 地址类型，None则由address推断
+        """
+        if not isinstance(obj_queue, SqliteQueue):
+            raise SqliteQueueError('Illegal param! "obj_queue" must be SqliteQueue!')
+        if authkey is None and (family or multiprocessing.connection.address_type(address)) != 'AF_UNIX':
+            raise SqliteQueueError('Illegal param! "authkey" is required unless listening on a Unix socket!')
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = obj_queue
+        self._authkey = authkey
+        self._listener = multiprocessing.connection.Listener(address, family, authkey=authkey)
+        self.address = self._listener.address
+        self._stopping = False
+
+    def run(self):
+        while not self._stopping:
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):  # 认证失败或连接中断
+                continue
+            if self._stopping:
+                conn.close()
+                break
+            _ServerConnection(self.queue, conn).start()
+        self._listener.close()
+
+    def stop(self):
+        """
+        停止接受新连接，已建立的连接不受影响
+        :return:
+        """
+        self._stopping = True
+        try:  # 唤醒阻塞在accept上的线程
+            multiprocessing.connection.Client(self.address, authkey=self._authkey).close()
+        except OSError:
+            pass
+
+
+class _ServerConnection(threading.Thread):
+    """
+    服务一个客户端连接。接收请求后立即注册任务，结果由发送线程按完成顺序写回，写线程不会阻塞在网络上
+    """
+
+    def __init__(self, obj_queue, conn):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._queue = obj_queue
+        self._conn = conn
+        self._outbox = queue.SimpleQueue()
+
+    def run(self):
+        sender = threading.Thread(target=self._send_loop, daemon=True)
+        sender.start()
+        try:
+            while True:
+                try:
+                    request = marshal.loads(self._conn.recv_bytes())
+                except (EOFError, OSError, ValueError, TypeError):  # 客户端断开或数据无法解码
+                    break
+                if not _valid_request(request):  # 客户端关闭连接，或请求格式错误时断开
+                    if request is not None:
+                        _logger.error('Closing connection after malformed request')
+                    break
+                request_id, execute, data, cacheable, priority, deadline = request
+                future = Future()
+                future.add_done_callback(lambda f, request_id=request_id: self._outbox.put((request_id, f)))
+                try:
+                    self._queue._register_task(execute, data, future=future, cacheable=cacheable, priority=priority,
+                                               deadline=deadline)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            self._outbox.put(None)
+            sender.join()
+            self._conn.close()
+
+    def _send_loop(self):
+        while True:
+            item = self._outbox.get()
+            if item is None:
+                break
+            request_id, future = item
+            try:
+                message = (request_id, tuple(future.result()), None)
+            except BaseException as e:  # 异常以类名与信息传回，由客户端重建
+                message = (request_id, None, (type(e).__name__, str(e)))
+            try:
+                payload = marshal.dumps(message)
+            except ValueError as e:  # 结果中有marshal不支持的值
+                payload = marshal.dumps((request_id, None, ('SqliteQueueError', 'Cannot encode result: %s' % e)))
+            try:
+                self._conn.send_bytes(payload)
+            except OSError:  # 客户端已断开，丢弃结果
+                pass
+
+
+class SqliteQueueClient:
+    """
+    SqliteQueueServer的客户端，在其他进程中使用，接口与SqliteQueue相同。
+    请求发出后不等待结果，由接收线程完成future或调用回调，因此可以同时有多个请求在执行
+    """
+
+    def __init__(self, address, authkey=None, family=None):
+        """
+        :param address: 服务端地址
+        :param authkey: 连接认证的密钥(bytes)
+        :param family: 地址类型，None则由address推断
+        """
+        self._conn = multiprocessing.connection.Client(address, family, authkey=authkey)
+        self._send_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = {}  # 请求号 -> future
+        self._ids = itertools.count()
+        self._closed = False
+        self._receiver = threading.Thread(target=self._receive_loop, daemon=True)
+        self._receiver.start()
+
+    def _receive_loop(self):
+        try:
+            while True:
+                request_id, result, error = marshal.loads(self._conn.recv_bytes())
+                with self._pending_lock:
+                    future = self._pending.pop(request_id)
+                if not future.set_running_or_notify_cancel():  # 调用者已取消
+                    continue
+                if error is not None:
+                    future.set_exception(_remote_error(*error))
+                else:
+                    future.set_result(QueryResult(*result))
+        except (EOFError, OSError):  # 连接断开
+            pass
+        except Exception:  # 收到无法处理的响应，不再使用该连接
+            _logger.exception('Failed to receive result from the server')
+            self._conn.close()
+        # 未完成的请求全部报错
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+            self._closed = True
+        for future in pending.values():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(SqliteQueueError('Connection to the server was closed!'))
+
+    def _register_task(self, execute, data=None, callback=None, future=None, cacheable=False,
+                       priority=PRIORITY_NORMAL, deadline=None, columnar=False, merge=None, block=None, timeout=None):
+        """
+        将任务发送到服务端
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param callback: 回调，在接收线程中调用
+        :param future: 任务完成时设置结果的future
+        :param cacheable: 结果是否可以缓存
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从服务端收到时算起
+        :param columnar: 是否按列返回结果，客户端不支持
+        :param merge: SqlQuery给出的UPDATE合并信息，请求中不传输，客户端忽略
+        :param block: 客户端忽略，队列满时按服务端队列的put_timeout处理
+        :param timeout: 客户端忽略
+        :return:
+        """
+        if columnar:
+            raise SqliteQueueError('Columnar results are not supported by SqliteQueueClient!')
+        if not isinstance(execute, str):
+            raise SqliteQueueError('Illegal param! "execute" must be string!')
+        elif data is not None and (not isinstance(data, tuple) and not isinstance(data, list)):
+            raise SqliteQueueError('Illegal param! "data" must be tuple or list!')
+        elif callback is not None and not callable(callback):
+            raise SqliteQueueError('Illegal param! "callback" must be callable!')
+        try:
+            request_id = next(self._ids)
+            payload = marshal.dumps((request_id, execute, data, cacheable, priority, deadline))
+        except ValueError as e:
+            raise SqliteQueueError('Illegal param! Cannot encode "data": %s' % e)
+        if future is None:
+            future = Future()
+        if callback is not None:
+            future.add_done_callback(functools.partial(_call_remote_callback, callback, _callback_plan(callback),
+                                                       execute))
+        with self._pending_lock:
+            if self._closed:
+                raise SqliteQueueError('Connection to the server was closed!')
+            self._pending[request_id] = future
+        with self._send_lock:
+            self._conn.send_bytes(payload)
+
+    def _register_group(self, sqls, callback=None, priority=PRIORITY_NORMAL, deadline=None, block=None,
+                        timeout=None):
+        """
+        注册多条语句，全部完成后只回调一次，参数见SqliteQueue._register_group
+        """
+        if callback is not None and not callable(callback):
+            raise SqliteQueueError('Illegal param! "callback" must be callable!')
+        combined = _combine_futures([self.submit_execute(*v, priority=priority, deadline=deadline) for v in sqls])
+        if callback is not None:
+            combined.add_done_callback(functools.partial(_call_remote_callback, callback, _callback_plan(callback),
+                                                         sqls[-1][0]))
+
+    def register_execute(self, execute, data=None, callback=None, priority=PRIORITY_NORMAL, deadline=None,
+                         block=None, timeout=None):
+        """
+        注册一个执行指定SQL命令的操作，参数见SqliteQueue.register_execute，block与timeout忽略
+        """
+        self._register_task(execute, data, callback=callback, priority=priority, deadline=deadline)
+
+    def submit_execute(self, execute, data=None, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        注册一个执行指定SQL命令的操作，返回future，参数见SqliteQueue.submit_execute，block与timeout忽略
+        """
+        future = Future()
+        self._register_task(execute, data, future=future, priority=priority, deadline=deadline)
+        return future
+
+    def close(self):
+        """
+        关闭连接，未完成的请求以SqliteQueueError报错
+        :return:
+        """
+        try:  # 通知服务端关闭，接收线程收到连接断开后退出
+            with self._send_lock:
+                self._conn.send_bytes(marshal.dumps(None))
+        except OSError:
+            pass
+        self._receiver.join()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def select(self, table):
+        return SqlQuery(table, obj_queue=self)
+
+    def insert(self, table, data=None):
+        return SqlQuery(table, 'INSERT', data, obj_queue=self)
+
+    def update(self, table, data=None):
+        return SqlQuery(table, 'UPDATE', data, obj_queue=self)
+
+    def delete(self, table):
+        return SqlQuery(table, 'DELETE', obj_queue=self)
+
+    def drop(self, table):
+        return SqlQuery(table, 'DROP', obj_queue=self)
+
+    def create(self, table, params=None):
+        return SqlQuery(table, 'CREATE', params, obj_queue=self)
+
+
+class ShardedSqliteQueue:
+    """
+    按分片键将任务分发到多个数据库文件，每个文件由一个SqliteQueue负责写入。
+    不带分片键的写操作在所有分片上执行，不带分片键的查询在所有分片上执行后合并结果
+    """
+
+    def __init__(self, dbs, shard_key=None, shard_func=None, **kwargs):
+        """
+        :param dbs: sqlite数据库文件列表，每个文件为一个分片
+        :param shard_key: 分片字段名。SqlQuery在where的相等条件或插入的数据中取该字段的值来选择分片
+        :param shard_func: 由分片键的值与分片数得到分片下标的函数，默认整数取模，其他值取crc32后取模
+        :param kwargs: 创建每个SqliteQueue的参数
+        """
+        if len(dbs) < 1:
+            raise SqliteQueueError('Illegal param! "dbs" needs at least one database!')
+        self.shards = [SqliteQueue(db, **kwargs) for db in dbs]
+        self.shard_key = shard_key
+        self.shard_func = shard_func if shard_func is not None else _shard_index
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def join(self, timeout=None):
+        for shard in self.shards:
+            shard.join(timeout)
+
+    def stats(self):
+        """
+        :return: 各分片SqliteQueue.stats()的列表
+        """
+        return [shard.stats() for shard in self.shards]
+
+    def shard(self, key):
+        """
+        取得分片键对应的SqliteQueue
+        :param key: 分片键的值
+        :return:
+        """
+        return self.shards[self.shard_func(key, len(self.shards))]
+
+    def register_execute(self, execute, data=None, callback=None, *, key=None, priority=PRIORITY_NORMAL,
+                         deadline=None, block=None, timeout=None):
+        """
+        注册一个操作
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param callback: 回调函数
+        :param key: 分片键的值。None则在所有分片上执行，查询结果按分片顺序拼接，写操作rowcount为总和
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return:
+        """
+        if key is not None:
+            self.shard(key).register_execute(execute, data, callback, priority, deadline, block=block,
+                                             timeout=timeout)
+        else:
+            if callback is not None and not callable(callback):
+                raise SqliteQueueError('Illegal param! "callback" must be callable!')
+            future = self.submit_execute(execute, data, priority=priority, deadline=deadline, block=block,
+                                         timeout=timeout)
+            self.shards[0]._callback_on(future, callback, execute)
+
+    def submit_execute(self, execute, data=None, *, key=None, priority=PRIORITY_NORMAL, deadline=None, block=None,
+                       timeout=None):
+        """
+        注册一个操作，返回future
+        :param execute: SQL语句
+        :param data: 预编译参数
+        :param key: 分片键的值，None则在所有分片上执行
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return: concurrent.futures.Future，结果为QueryResult
+        """
+        if key is not None:
+            return self.shard(key).submit_execute(execute, data, priority, deadline, block=block, timeout=timeout)
+        futures = [shard.submit_execute(execute, data, priority, deadline, block=block, timeout=timeout)
+                   for shard in self.shards]
+        if _is_read_only(execute):
+            return _combine_futures(futures, _merge_results)
+        return _combine_futures(futures)
+
+    def select(self, table):
+        return ShardedQuery(table, obj_queue=self)
+
+    def insert(self, table, data=None):
+        return ShardedQuery(table, 'INSERT', data, obj_queue=self)
+
+    def update(self, table, data=None):
+        return ShardedQuery(table, 'UPDATE', data, obj_queue=self)
+
+    def delete(self, table):
+        return ShardedQuery(table, 'DELETE', obj_queue=self)
+
+    def drop(self, table):
+        return ShardedQuery(table, 'DROP', obj_queue=self)
+
+    def create(self, table, params=None):
+        return ShardedQuery(table, 'CREATE', params, obj_queue=self)
+
+
+class SqlQuery:
+    """
+    简单的sql命令封装
+    """
+
+    def __init__(self, table, method='SELECT', params=None, obj_queue=None):
+        self._queue = obj_queue
+        self._sql = {'table': table, 'method': method, 'distinct': False}
+        self._params = params
+        self._data = None
+        self._columnar = False
+        self._equality = None  # 只有一个相等条件时为(字段, 值)，用于合并UPDATE
+
+    def execute(self, command, data=None):
+        self._sql = command
+        self._data = data
+        return self
+
+    def _is_select(self):
+        """
+        是否为SqlQuery构建的SELECT语句
+        :return:
+        """
+        return isinstance(self._sql, dict) and self._sql['method'].upper() == 'SELECT'
+
+    def _mergeable(self):
+        """
+        :return: 可以合并的UPDATE返回(表, 更新的数据, 条件字段, 条件值)，否则返回None
+        """
+        if not isinstance(self._sql, dict) or self._sql['method'].upper() != 'UPDATE' or self._equality is None \
+                or not isinstance(self._queue, SqliteQueue) or not self._queue.coalesce_updates:
+            return None
+        if any(isinstance(v, Param) for v in self._params.values()):
+            return None
+        return (self._sql['table'], self._params) + self._equality
+
+    def _has_commanded(self):
+        """
+        检查是否执行过execute方法
+        :return:
+        """
+        if isinstance(self._sql, str):
+            raise Exception('This method cannot be invoked after using method "execute"!')
+
+    def table(self, table):
+        """
+        设定操作的目标表
+        :param table:
+        :return:
+        """
+        self._has_commanded()
+        self._sql['table'] = table
+        return self
+
+    def field(self, *args):
+        """
+        表示操作对象的字段
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        result = ''
+        if len(args) < 1:
+            raise ValueError('Method "field" needs at least one param!')
+        elif len(args) == 1:
+            args = args[0]
+            if isinstance(args, str):  # 若为字符串，则视为直接输入SQL格式
+                result = args + ' '  # 空格占位哈哈哈哈，我有毒
+            elif isinstance(args, dict):  # 若为字典，则可能有as
+                if len(args) < 1:
+                    raise ValueError('Illegal length of param for method "field"!')
+                for k, v in args.items():
+                    if v is None:
+                        result += '`%s`,' % str(k)
+                    else:
+                        result += '`%s` AS %s,' % (str(k), str(v))
+            else:
+                raise ValueError('Illegal param for method "field"!')
+        else:
+            for v in args:  # 直接拼接即可
+                result += '`%s`,' % str(v)
+        self._sql['field'] = result[:-1]
+        return self
+
+    def where(self, *args):
+        """
+        设置where条件，重复调用会叠加并使用AND连接
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        cond = _parse_condition(*args)
+        if 'where' in self._sql:  # 已经存在where了，拼接之
+            self._sql['where'][0] += ' AND ' + cond[0]  # 拼接条件语句
+            self._sql['where'][1] += cond[1]  # 拼接参数
+            self._equality = None
+        else:
+            self._sql['where'] = cond
+            self._equality = _simple_equality(args)
+        return self
+
+    def or_where(self, *args):
+        """
+        设置where条件，重复调用会叠加并使用OR连接
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        if 'where' in self._sql:  # 已经存在where了，拼接之
+            cond = _parse_condition(*args)
+            self._sql['where'][0] += ' OR ' + cond[0]  # 拼接条件语句
+            self._sql['where'][1] += cond[1]  # 拼接参数
+            self._equality = None
+        else:  # 不存在和where方法相同
+            self.where(*args)
+        return self
+
+    def order(self, *args):
+        """
+        设置排序字段
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        result = ''
+        if len(args) < 1:
+            raise ValueError('Method "order" needs at least one param!')
+        elif len(args) == 1 and _is_sql(args[0]):  # SQL格式
+            self._sql['order'] = args[0]
+            return self
+        elif isinstance(args[0], dict):  # 含排序方式
+            for k, v in args[0].items():
+                if v is None:
+                    result += '`%s`,' % str(k)
+                else:
+                    result += '`%s` %s,' % (str(k), str(v))
+        else:
+            for v in args:
+                result += '`%s`,' % str(v)
+        self._sql['order'] = result[:-1]
+        return self
+
+    def group(self, *args):
+        """
+        设置结果分组(GROUP BY)
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        result = ''
+        if len(args) < 1:
+            raise ValueError('Method "order" needs at least one param!')
+        elif len(args) == 1 and _is_sql(args[0]):  # SQL格式
+            self._sql['group'] = args[0]
+            return self
+        else:
+            for v in args:
+                result += '`%s`,' % str(v)
+        self._sql['group'] = result[:-1]
+        return self
+
+    def limit(self, start, num):
+        """
+        设置返回条数限制
+        :param start: 开始位置
+        :param num: 返回条数
+        :return:
+        """
+        self._has_commanded()
+        # 参数检查，模板参数在绑定时才有值
+        if not isinstance(start, Param) and int(start) < 0:
+            raise ValueError('The value of param "start" must be positive number!')
+        if not isinstance(num, Param) and int(num) < 1:
+            raise ValueError('The value of param "num" must bigger than zero!')
+        self._sql['limit'] = ['?,?', [start, num]]
+        return self
+
+    def page(self, index, num):
+        """
+        返回结果分页
+        :param index: 页码，1开始
+        :param num: 单页结果数
+        :return:
+        """
+        self.limit((int(index) - 1) * int(num), int(num))
+        return self
+
+    def having(self, *args):
+        """
+        设置having条件，重复调用会叠加并使用AND连接
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        cond = _parse_condition(*args)
+        if 'having' in self._sql:  # 已经存在where了，拼接之
+            self._sql['having'][0] += ' AND ' + cond[0]  # 拼接条件语句
+            self._sql['having'][1] += cond[1]  # 拼接参数
+        else:
+            self._sql['having'] = cond
+        return self
+
+    def or_having(self, *args):
+        """
+        设置having条件，重复调用会叠加并使用OR连接
+        :param args:
+        :return:
+        """
+        self._has_commanded()
+        if 'having' in self._sql:  # 已经存在where了，拼接之
+            cond = _parse_condition(*args)
+            self._sql['having'][0] += ' OR ' + cond[0]  # 拼接条件语句
+            self._sql['having'][1] += cond[1]  # 拼接参数
+        else:  # 不存在和where方法相同
+            self.having(*args)
+        return self
+
+    def distinct(self, is_distinct):
+        """
+        设置是否返回重复值
+        :param is_distinct: 是否返回重复值
+        :type is_distinct: bool
+        :return:
+        """
+        self._has_commanded()
+        self._sql['distinct'] = bool(is_distinct)
+        return self
+
+    def columnar(self, is_columnar=True):
+        """
+        设置是否按列返回结果，用于分析大量数据。见SqliteQueue.submit_execute
+        :param is_columnar: 是否按列返回
+        :return:
+        """
+        self._columnar = bool(is_columnar)
+        return self
+
+    def data(self, data):
+        """
+        增加命令所需数据。如INSERT, UPDATE。
+        :param data:
+        :return:
+        """
+        self._params = data
+        return self
+
+    def get_sql(self):
+        """
+        生成sql语句
+        :return: 元组，若长度为2则包含参数
+        """
+        if isinstance(self._sql, str):
+            if self._data is None:
+                return self._sql,
+            else:
+                return self._sql, self._data
+        method = self._sql['method'].upper()
+        # select语句顺序: SELECT-field-from-where-order-group-limit-having
+        if method == 'SELECT':  # 生成SELECT语句
+            if 'field' not in self._sql:
+                field = '*'
+            else:
+                field = self._sql['field']
+            if self._sql['distinct']:
+                distinct = 'DISTINCT '
+            else:
+                distinct = ''
+            sql = 'SELECT %s%s FROM %s' % (distinct, field, self._sql['table'])
+            data = []
+            if 'where' in self._sql:
+                sql += ' WHERE ' + self._sql['where'][0]
+                data += self._sql['where'][1]
+            if 'order' in self._sql:
+                sql += ' ORDER BY ' + self._sql['order']
+            if 'group' in self._sql:
+                sql += ' GROUP BY ' + self._sql['group']
+            if 'limit' in self._sql:
+                sql += ' LIMIT ' + self._sql['limit'][0]
+                data += self._sql['limit'][1]
+            if 'having' in self._sql:
+                sql += ' HAVING ' + self._sql['having'][0]
+                data += self._sql['having'][1]
+            return sql, tuple(data)
+        elif method == 'INSERT':  # 生成INSERT语句
+            if isinstance(self._params, dict) and len(self._params) > 0:
+                dic = [self._params]
+            elif isinstance(self._params, list) and len(self._params) > 0:
+                dic = self._params
+            else:
+                raise ValueError('Illegal value for param!')
+            groups = {}  # 按字段集合分组，同组的数据使用executemany，字段按组内第一行的顺序
+            orders = {}  # 字段顺序 -> 所在的组，字段顺序相同时不必再按集合查找
+            for v in dic:
+                keys = tuple(v.keys())
+                group = orders.get(keys)
+                if group is None:
+                    group = orders[keys] = groups.setdefault(frozenset(keys), (keys, []))
+                group[1].append(tuple(v.values()) if group[0] == keys else tuple(v[k] for k in group[0]))
+            result = []
+            for keys, values in groups.values():
+                sql = 'INSERT INTO %s (' % self._sql['table']
+                for k in keys:
+                    sql += '`%s`,' % k
+                sql = sql[:-1] + ') VALUES (' + ('?,' * len(keys))[:-1] + ')'
+                result.append((sql, values[0] if len(values) == 1 else values))
+            return result
+        elif method == 'UPDATE':  # 生成UPDATE语句
+            if not isinstance(self._params, dict) or len(self._params) < 1:
+                raise ValueError('Illegal value for param!')
+            sql = 'UPDATE %s SET ' % self._sql['table']
+            data = []
+            for k in self._params.keys():
+                sql += '`%s`=?,' % k
+            sql = sql[:-1]  # 去除多余逗号
+            data += self._params.values()
+            if 'where' in self._sql:
+                sql += ' WHERE ' + self._sql['where'][0]
+                data += self._sql['where'][1]
+            return sql, tuple(data)
+        elif method == 'DELETE':  # 生成DELETE语句
+            sql = 'DELETE FROM %s' % self._sql['table']
+            data = []
+            if 'where' in self._sql:
+                sql += ' WHERE ' + self._sql['where'][0]
+                data += self._sql['where'][1]
+            return sql, tuple(data)
+        elif method == 'TRUNCATE':
+            raise Exception('Method "TRUNCATE" wasn\'t support in sqlite!')
+        elif method == 'DROP':  # 生成DROP语句
+            return 'DROP TABLE ' + self._sql['table'],
+        elif method == 'CREATE':
+            sql = 'CREATE TABLE `%s`(' % self._sql['table']
+            for k, v in self._params.items():
+                sql += '%s %s,' % (k, v)
+            return sql[:-1] + ')',
+        else:
+            raise Exception("Unknown method %s!" % method)
+
+    def register(self, callback=None, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        注册为SqliteQueue的任务
+        :param callback: 回调函数
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return:
+        """
+        if self._queue is None or not isinstance(self._queue, (SqliteQueue, SqliteQueueClient)):
+            raise Exception("This object wasn't belong to a SqliteQueue!")
+        sql = self.get_sql()
+        if not isinstance(sql, list):
+            sql = [sql]
+        if len(sql) == 1:
+            self._queue._register_task(*sql[0], callback=callback, cacheable=self._is_select(),
+                                       priority=priority, deadline=deadline, columnar=self._columnar,
+                                       merge=self._mergeable(), block=block, timeout=timeout)
+        else:  # 字段不同的批量插入，全部完成后回调一次
+            self._queue._register_group(sql, callback=callback, priority=priority, deadline=deadline, block=block,
+                                        timeout=timeout)
+        return self
+
+    def submit(self, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        注册为SqliteQueue的任务，返回future
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return: concurrent.futures.Future，结果为QueryResult。批量插入时为最后一条的结果，rowcount为总行数
+        """
+        if self._queue is None or not isinstance(self._queue, (SqliteQueue, SqliteQueueClient)):
+            raise Exception("This object wasn't belong to a SqliteQueue!")
+        sql = self.get_sql()
+        if not isinstance(sql, list):
+            future = Future()
+            self._queue._register_task(*sql, future=future, cacheable=self._is_select(),
+                                       priority=priority, deadline=deadline, columnar=self._columnar,
+                                       merge=self._mergeable(), block=block, timeout=timeout)
+            return future
+        if len(sql) == 1:
+            return self._queue.submit_execute(*sql[0], priority=priority, deadline=deadline, block=block,
+                                              timeout=timeout)
+        return _combine_futures([self._queue.submit_execute(*v, priority=priority, deadline=deadline, block=block,
+                                                            timeout=timeout) for v in sql])
+
+    async def fetch(self, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        在asyncio中执行，不阻塞事件循环
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return: QueryResult
+        """
+        return await asyncio.wrap_future(self.submit(priority, deadline, block, timeout))
+
+    def stream(self, chunk_size=1000, callback=None, buffer=4):
+        """
+        注册为流式返回结果的任务，参数见SqliteQueue.stream_execute
+        :param chunk_size: 每批的行数
+        :param callback: 每批数据调用一次的回调，为None时返回ResultStream
+        :param buffer: 最多缓冲的批数
+        :return: 无回调时返回ResultStream
+        """
+        if self._queue is None or not isinstance(self._queue, SqliteQueue):
+            raise Exception("This object wasn't belong to a SqliteQueue!")
+        sql = self.get_sql()
+        if isinstance(sql, list):
+            raise Exception('Method "stream" cannot be used with batch insert!')
+        return self._queue.stream_execute(*sql, chunk_size=chunk_size, callback=callback, buffer=buffer)
+
+    def iterate_by(self, key, batch=5000, descending=False, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        按键分页遍历查询结果。每批以WHERE key > 上一批最后的值 ORDER BY key LIMIT batch查询，
+        不像page那样需要跳过前面的行，每批的开销不随页码增加。每批都单独注册为任务并等待结果，
+        因此不能在工作线程与读线程中调用，如callback_executor为None时的回调中
+        :param key: 分页的字段，值需唯一，结果中需包含该字段
+        :param batch: 每批的行数
+        :param descending: 是否按键降序遍历
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 每批的截止时间，单位秒
+        :return: 生成器，每次得到一批数据
+        """
+        self._has_commanded()
+        if not self._is_select():
+            raise Exception('Method "iterate_by" can only be used with SELECT!')
+        for clause in ('order', 'limit', 'group', 'having'):
+            if clause in self._sql:
+                raise Exception('Method "iterate_by" cannot be used with "%s"!' % clause)
+        if int(batch) < 1:
+            raise ValueError('The value of param "batch" must bigger than zero!')
+        if isinstance(threading.current_thread(), (SqliteQueue, _SqliteReader)):  # 等待自己执行的任务会死锁
+            raise SqliteQueueError('Method "iterate_by" cannot be used in the worker or reader thread!')
+        last = None
+        while True:
+            query = copy.copy(self)
+            query._sql = copy.deepcopy(self._sql)
+            if last is not None:  # 原条件可能含OR，加括号后再拼接
+                cond = ['`%s` %s ?' % (key, '<' if descending else '>'), [last]]
+                if 'where' in query._sql:
+                    where = query._sql['where']
+                    cond = ['(%s) AND %s' % (where[0], cond[0]), list(where[1] or []) + cond[1]]
+                query._sql['where'] = cond
+            query._sql['order'] = '`%s`%s' % (key, ' DESC' if descending else '')
+            query._sql['limit'] = ['?,?', [0, int(batch)]]
+            result = query.submit(priority, deadline).result()
+            data = result.data
+            count = len(next(iter(data.values()), ())) if isinstance(data, dict) else len(data)
+            if count:
+                if result.columns is None or key not in result.columns:
+                    raise Exception('Field "%s" of method "iterate_by" must be in the result!' % key)
+                elif isinstance(data, dict):  # 按列返回
+                    last = data[key][-1]
+                else:
+                    last = data[-1][result.columns.index(key)]
+                yield data
+            if count < int(batch):
+                break
+
+    def prepare(self):
+        """
+        编译为可重复使用的模板。参数中的Param对象在绑定时赋值，SQL语句只生成一次
+        :return: PreparedQuery
+        """
+        sql = self.get_sql()
+        if isinstance(sql, list):
+            if len(sql) != 1 or isinstance(sql[0][1], list):
+                raise Exception('Method "prepare" cannot be used with batch insert!')
+            sql = sql[0]
+        return PreparedQuery(sql[0], sql[1] if len(sql) > 1 else (), obj_queue=self._queue,
+                             cacheable=self._is_select(), columnar=self._columnar)
+
+
+class Pipeline:
+    """
+    多条语句作为一个任务注册，在一个事务中依次执行并只提交一次，任何一条出错时全部回滚。
+    后面的语句可以在参数中引用前面语句的结果，如插入父记录后用其lst_rowid插入子记录
+    """
+
+    def __init__(self, obj_queue):
+        """
+        :param obj_queue: SqliteQueue对象，SqliteQueueClient与ShardedSqliteQueue不支持
+        """
+        if not isinstance(obj_queue, SqliteQueue):
+            raise SqliteQueueError('Illegal param! "obj_queue" must be SqliteQueue!')
+        self._queue = obj_queue
+        self._steps = []
+
+    def execute(self, execute, data=None):
+        """
+        增加一条SQL语句
+        :param execute: SQL语句
+        :param data: 预编译参数，可以包含PipelineStep的lst_rowid、rowcount、value
+        :return: PipelineStep，用于在后面的语句中引用该语句的结果
+        """
+        if not isinstance(execute, str):
+            raise SqliteQueueError('Illegal param! "execute" must be string!')
+        elif data is not None and (not isinstance(data, tuple) and not isinstance(data, list)):
+            raise SqliteQueueError('Illegal param! "data" must be tuple or list!')
+        self._steps.append((execute, data))
+        return PipelineStep(len(self._steps) - 1)
+
+    register_execute = execute
+
+    def add(self, query):
+        """
+        增加SqlQuery构建的语句，字段不同的批量插入会拆成多条
+        :param query: SqlQuery对象，参数中可以包含对前面语句结果的引用
+        :return: PipelineStep，批量插入时为最后一条
+        """
+        sql = query.get_sql()
+        if not isinstance(sql, list):
+            sql = [sql]
+        step = None
+        for v in sql:
+            step = self.execute(*v)
+        return step
+
+    def register(self, callback=None, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        注册为SqliteQueue的任务
+        :param callback: 回调函数，data为各条语句的QueryResult列表
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :return:
+        """
+        self._queue._register_task(*self._task_sql(), callback=callback, priority=priority, deadline=deadline,
+                                   steps=list(self._steps))
+        return self
+
+    def submit(self, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        注册为SqliteQueue的任务，返回future
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :return: concurrent.futures.Future，结果为QueryResult，data为各条语句的QueryResult列表，
+                 lst_rowid为最后一条语句的结果，rowcount为总行数
+        """
+        future = Future()
+        self._queue._register_task(*self._task_sql(), future=future, priority=priority, deadline=deadline,
+                                   steps=list(self._steps))
+        return future
+
+    async def fetch(self, priority=PRIORITY_NORMAL, deadline=None):
+        """
+        在asyncio中执行，不阻塞事件循环
+        :return: QueryResult
+        """
+        return await asyncio.wrap_future(self.submit(priority, deadline))
+
+    def _task_sql(self):
+        """
+        :return: 用于日志与统计的SQL语句
+        """
+        if not self._steps:
+            raise SqliteQueueError('Pipeline has no statement!')
+        return '; '.join(execute for execute, _ in self._steps), None
+
+
+class PipelineStep:
+    """
+    Pipeline中的一条语句，其属性在后面语句的参数中使用，执行时替换为该语句的结果
+    """
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    @property
+    def lst_rowid(self):
+        return _StepRef(self.index, 'lst_rowid')
+
+    @property
+    def rowcount(self):
+        return _StepRef(self.index, 'rowcount')
+
+    @property
+    def value(self):
+        """
+        查询结果第一行第一列的值，没有结果时为None
+        """
+        return _StepRef(self.index, 'value')
+
+
+class _StepRef:
+    """
+    对Pipeline中某条语句结果的引用
+    """
+    __slots__ = ('index', 'attr')
+
+    def __init__(self, index, attr):
+        self.index = index
+        self.attr = attr
+
+    def __repr__(self):
+        return '_StepRef(%d, %r)' % (self.index, self.attr)
+
+    def resolve(self, results):
+        """
+        :param results: 已执行语句的QueryResult列表
+        :return:
+        """
+        if self.index >= len(results):
+            raise SqliteQueueError('Pipeline step %d is referenced before it is executed!' % self.index)
+        result = results[self.index]
+        if self.attr == 'value':
+            return result.data[0][0] if result.data else None
+        return getattr(result, self.attr)
+
+
+class Param:
+    """
+    模板参数占位，用于SqlQuery.prepare
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
+
+
+class PreparedQuery:
+    """
+    预编译的SQL模板，重复执行时只需绑定参数，SQL语句保持不变，可以命中sqlite的语句缓存
+    """
+
+    def __init__(self, sql, data=(), obj_queue=None, cacheable=False, columnar=False):
+        """
+        :param sql: SQL语句
+        :param data: 预编译参数，其中的Param对象在绑定时赋值
+        :param obj_queue: SqliteQueue对象
+        :param cacheable: 结果是否可以缓存，由SELECT编译时为True
+        :param columnar: 是否按列返回结果
+        """
+        self._queue = obj_queue
+        self._cacheable = cacheable
+        self._columnar = columnar
+        self.sql = sql
+        self._slots = tuple((v.name, None) if isinstance(v, Param) else (None, v) for v in data)
+        self.names = frozenset(name for name, _ in self._slots if name is not None)
+
+    def bind(self, values=None, **kwargs):
+        """
+        绑定参数
+        :param values: 参数名到值的dict
+        :param kwargs: 也可以用关键字参数传入
+        :return: (SQL语句, 预编译参数)
+        """
+        if values is None:
+            values = kwargs
+        elif kwargs:
+            values = dict(values, **kwargs)
+        try:
+            return self.sql, tuple(v if name is None else values[name] for name, v in self._slots)
+        except KeyError as e:
+            raise ValueError('Missing value for param: %s' % e.args[0])
+
+    def _check_queue(self):
+        if self._queue is None or not isinstance(self._queue, (SqliteQueue, SqliteQueueClient)):
+            raise Exception("This object wasn't belong to a SqliteQueue!")
+
+    def register(self, values=None, callback=None, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        绑定参数并注册为SqliteQueue的任务
+        :param values: 参数名到值的dict
+        :param callback: 回调函数
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return:
+        """
+        self._check_queue()
+        self._queue._register_task(*self.bind(values), callback=callback, cacheable=self._cacheable,
+                                   priority=priority, deadline=deadline, columnar=self._columnar, block=block,
+                                   timeout=timeout)
+        return self
+
+    def submit(self, values=None, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        绑定参数并注册为SqliteQueue的任务，返回future
+        :param values: 参数名到值的dict
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return: concurrent.futures.Future
+        """
+        self._check_queue()
+        future = Future()
+        self._queue._register_task(*self.bind(values), future=future, cacheable=self._cacheable,
+                                   priority=priority, deadline=deadline, columnar=self._columnar, block=block,
+                                   timeout=timeout)
+        return future
+
+    async def fetch(self, values=None, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        """
+        在asyncio中执行
+        :param values: 参数名到值的dict
+        :param priority: 优先级，PRIORITY_INTERACTIVE、PRIORITY_NORMAL或PRIORITY_BULK
+        :param deadline: 截止时间，单位秒，从注册时算起。超时仍未执行的任务会被丢弃并以SqliteQueueTimeout报错
+        :param block: 队列满时是否等待，None则按put_timeout
+        :param timeout: block为True时最多等待的时间，单位秒，None则一直等待
+        :return: QueryResult
+        """
+        return await asyncio.wrap_future(self.submit(values, priority, deadline, block, timeout))
+
+
+class ShardedQuery(SqlQuery):
+    """
+    ShardedSqliteQueue的SQL命令封装。能确定分片键时只在一个分片上执行，否则在所有分片上执行，
+    查询结果合并后再按ORDER BY排序、按LIMIT截取
+    """
+
+    def __init__(self, table, method='SELECT', params=None, obj_queue=None):
+        SqlQuery.__init__(self, table, method, params, obj_queue)
+        self._key = None  # where中分片字段的相等条件
+        self._routable = True  # 有OR条件时无法确定分片
+
+    def where(self, *args):
+        if self._key is None and self._queue.shard_key is not None:
+            self._key = _condition_key(self._queue.shard_key, args)
+        return SqlQuery.where(self, *args)
+
+    def or_where(self, *args):
+        if 'where' in self._sql:
+            self._routable = False
+        return SqlQuery.or_where(self, *args)
+
+    def _target(self):
+        """
+        :return: 只在一个分片上执行时返回该分片，否则返回None
+        """
+        if isinstance(self._sql, dict) and self._routable and self._key is not None:
+            return self._queue.shard(self._key)
+        return None
+
+    def _bind(self, shard, params=None):
+        """
+        :param shard: 分片
+        :param params: 插入的数据，None则沿用
+        :return: 在该分片上执行的SqlQuery
+        """
+        query = SqlQuery(None, obj_queue=shard)
+        query._sql = copy.deepcopy(self._sql)
+        query._params = self._params if params is None else params
+        query._data = self._data
+        query._columnar = self._columnar
+        query._equality = self._equality
+        return query
+
+    def _insert_groups(self):
+        """
+        按分片拆分插入的数据
+        :return: 分片到该分片上数据的dict
+        """
+        rows = [self._params] if isinstance(self._params, dict) else self._params
+        if self._queue.shard_key is None or not isinstance(rows, list) or len(rows) < 1:
+            raise ValueError('Illegal value for param!')
+        groups = {}
+        for row in rows:
+            if self._queue.shard_key not in row:
+                raise SqliteQueueError('Missing shard key "%s" in inserted data!' % self._queue.shard_key)
+            groups.setdefault(self._queue.shard(row[self._queue.shard_key]), []).append(row)
+        return groups
+
+    def _scatter(self, priority, deadline, block, timeout):
+        """
+        在所有分片上执行。查询时每个分片取前start+num条，合并后再排序截取
+        :return: future
+        """
+        if isinstance(self._sql, dict) and self._sql['method'].upper() == 'INSERT':
+            groups = self._insert_groups()
+            return _combine_futures([self._bind(shard, rows).submit(priority, deadline, block, timeout)
+                                     for shard, rows in groups.items()])
+        if not self._is_select():
+            return self._queue.submit_execute(*self.get_sql(), priority=priority, deadline=deadline, block=block,
+                                              timeout=timeout)
+        if 'group' in self._sql or 'having' in self._sql:
+            raise SqliteQueueError('GROUP BY cannot be merged across shards!')
+        if self._columnar:  # 合并、排序与截取都按行进行
+            raise SqliteQueueError('Columnar results cannot be merged across shards!')
+        queries = [self._bind(shard) for shard in self._queue.shards]
+        window = None
+        if 'limit' in self._sql:
+            start, num = self._sql['limit'][1]
+            window = (int(start), int(start) + int(num))
+            for query in queries:
+                query._sql['limit'] = ['?,?', [0, window[1]]]
+        order = _order_terms(self._sql['order']) if 'order' in self._sql else None
+        distinct = self._sql['distinct']
+        return _combine_futures([query.submit(priority, deadline, block, timeout) for query in queries],
+                                lambda results: _merge_results(results, order, window, distinct))
+
+    def register(self, callback=None, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        target = self._target()
+        if target is not None:
+            self._bind(target).register(callback, priority, deadline, block, timeout)
+        else:
+            if callback is not None and not callable(callback):
+                raise SqliteQueueError('Illegal param! "callback" must be callable!')
+            execute = self._sql['method'] if isinstance(self._sql, dict) else self._sql
+            self._queue.shards[0]._callback_on(self._scatter(priority, deadline, block, timeout), callback, execute)
+        return self
+
+    def submit(self, priority=PRIORITY_NORMAL, deadline=None, block=None, timeout=None):
+        target = self._target()
+        if target is not None:
+            return self._bind(target).submit(priority, deadline, block, timeout)
+        return self._scatter(priority, deadline, block, timeout)
+
+    def stream(self, chunk_size=1000, callback=None, buffer=4):
+        target = self._target()
+        if target is None:
+            raise Exception('Method "stream" needs the shard key!')
+        return self._bind(target).stream(chunk_size, callback, buffer)
+
+    def prepare(self):
+        target = self._target()
+        if target is None:
+            raise Exception('Method "prepare" needs the shard key!')
+        return self._bind(target).prepare()
+
+
+class SqliteQueueError(Exception):
+    pass
+
+
+class SqliteQueueFull(SqliteQueueError):
+    """
+    队列已满，无法注册任务
+    """
+    pass
+
+
+class SqliteQueueTimeout(SqliteQueueError):
+    """
+    任务超过截止时间仍未执行
+    """
+    pass
+
+
+def _callback_plan(callback):
+    """
+    解析回调函数的参数，得到(参数名, QueryResult下标)的元组。普通函数与方法按code对象缓存
+    :param callback: 回调
+    :return:
+    """
+    func = getattr(callback, '__func__', callback)  # 绑定方法
+    if isinstance(func, types.FunctionType):
+        return _code_plan(func.__code__, func is not callback,
+                          len(func.__defaults__ or ()), frozenset(func.__kwdefaults__ or ()))
+    try:  # functools.partial等其他可调用对象
+        params = inspect.signature(callback).parameters.values()
+    except ValueError:  # 无法取得签名，不传参数
+        return ()
+    names = [p.name for p in params if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY)
+             and (p.name in _RESULT_INDEX or p.default is p.empty)]
+    return _make_plan(names, any(p.kind == p.VAR_KEYWORD for p in params))
+
+
+@functools.lru_cache(maxsize=1024)
+def _code_plan(code, bound, defaults, kwdefaults):
+    """
+    由code对象解析回调函数的参数
+    :param code: 函数的code对象
+    :param bound: 是否为绑定方法，是则跳过第一个参数
+    :param defaults: 有默认值的位置参数个数
+    :param kwdefaults: 有默认值的关键字参数名
+    :return:
+    """
+    names = code.co_varnames[:code.co_argcount]
+    names = [name for i, name in enumerate(names) if i < len(names) - defaults or name in _RESULT_INDEX]
+    names += [name for name in code.co_varnames[code.co_argcount:code.co_argcount + code.co_kwonlyargcount]
+              if name not in kwdefaults or name in _RESULT_INDEX]
+    if bound:
+        names = names[1:]
+    return _make_plan(names, bool(code.co_flags & inspect.CO_VARKEYWORDS))
+
+
+def _make_plan(names, var_keyword):
+    """
+    :param names: 参数名，无法识别且有默认值的参数不在其中，保留默认值
+    :param var_keyword: 是否有**kwargs，有则传入全部结果
+    :return:
+    """
+    plan = [(name, _RESULT_INDEX.get(name)) for name in names]
+    if var_keyword:
+        plan += [(name, index) for name, index in _RESULT_INDEX.items() if name not in names]
+    return tuple(plan)
+
+
+def _is_read_only(sql):
+    """
+    判断SQL语句是否只读
+    :param sql: SQL语句
+    :return:
+    """
+    if _READ_ONLY_SQL.match(sql):
+        return True
+    return bool(_WITH_SQL.match(sql)) and not _WRITE_KEYWORD.search(sql)
+
+
+def _table_name(name):
+    """
+    统一表名格式，去除引号与库名
+    :param name: 表名
+    :return:
+    """
+    return name.strip('`"[]').split('.')[-1].strip('`"[]').lower()
+
+
+def _hashable(value):
+    """
+    :param value: 值
+    :return: 是否可以作为dict的键
+    """
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _read_tables(sql):
+    """
+    解析只读语句读取的表
+    :param sql: SQL语句
+    :return: 表名的frozenset，有子查询或逗号连接时为空集
+    """
+    if _COMPLEX_FROM.search(sql):
+        return frozenset()
+    return frozenset(_table_name(name) for name in _READ_TABLE.findall(sql))
+
+
+def _has_view(cursor, tables):
+    """
+    检查读取的表中是否有视图，视图依赖的表无法从语句中得知
+    :param cursor: cursor
+    :param tables: 表名
+    :return:
+    """
+    marks = ','.join('?' * len(tables))
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND lower(name) IN (%s) UNION ALL "
+                   "SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND lower(name) IN (%s) LIMIT 1"
+                   % (marks, marks), tuple(tables) * 2)
+    return cursor.fetchone() is not None
+
+
+def _written_tables(sql):
+    """
+    解析写语句修改的表
+    :param sql: SQL语句
+    :return: 表名的frozenset，不修改数据的语句为空集，无法解析时为None
+    """
+    match = _WRITE_TABLE.match(sql)
+    if match is not None:
+        return frozenset([_table_name(match.group(1))])
+    if _NO_WRITE_SQL.match(sql):
+        return frozenset()
+    return None
+
+
+def _steps_written(steps):
+    """
+    解析Pipeline各条语句修改的表
+    :param steps: (SQL语句, 预编译参数)的列表
+    :return: 表名的frozenset，有无法解析的语句时为None
+    """
+    written = frozenset()
+    for execute, _ in steps:
+        if _is_read_only(execute):
+            continue
+        tables = _written_tables(execute)
+        if tables is None:
+            return None
+        written |= tables
+    return written
+
+
+def _resolve_refs(row, results):
+    """
+    替换参数中对Pipeline前面语句结果的引用
+    :param row: 预编译参数
+    :param results: 已执行语句的QueryResult列表
+    :return:
+    """
+    if not any(isinstance(v, _StepRef) for v in row):
+        return row
+    return tuple(v.resolve(results) if isinstance(v, _StepRef) else v for v in row)
+
+
+@functools.lru_cache(maxsize=1024)
+def _normalize_sql(sql):
+    """
+    去除SQL语句中的字面量，得到用于统计的语句形状
+    :param sql: SQL语句
+    :return:
+    """
+    sql = _SQL_LITERAL.sub('?', sql)
+    sql = _IN_LIST.sub('IN (?)', sql)
+    return ' '.join(sql.split())
+
+
+def _task_size(execute, data):
+    """
+    估计任务占用的字节数
+    :param execute: SQL语句
+    :param data: 预编译参数
+    :return:
+    """
+    size = len(execute)
+    if isinstance(data, list):  # executemany
+        rows = data
+    elif data is not None:
+        rows = [data]
+    else:
+        rows = []
+    for row in rows:
+        for v in row:
+            size += len(v) if isinstance(v, (str, bytes)) else 8
+    return size
+
+
+def _peewee_sql(pw_query):
+    """
+    取得peewee查询对象的SQL语句与参数
+    :param pw_query: peewee查询对象
+    :return:
+    """
+    if not __peewee__:
+        raise SqliteQueueError('Module "peewee" have not been installed.')
+    if not isinstance(pw_query, peewee.Query):
+        raise SqliteQueueError('Illegal param! "pw_query" must be peewee.Query!')
+    return pw_query.sql()
+
+
+def _combine_futures(futures, merge=None):
+    """
+    合并多个任务的future，全部完成后得到最后一个任务的结果，rowcount为总和
+    :param futures: future列表
+    :param merge: 由各任务的结果得到合并结果的函数，None则按上述方式合并
+    :return:
+    """
+    combined = Future()
+    combined.set_running_or_notify_cancel()
+    lock = threading.Lock()
+    remain = [len(futures)]
+
+    def done(_):
+        with lock:
+            remain[0] -= 1
+            if remain[0] > 0:
+                return
+        for f in futures:
+            if f.cancelled() or f.exception() is not None:
+                combined.set_exception(f.exception() if not f.cancelled() else CancelledError())
+                return
+        if merge is not None:
+            try:
+                combined.set_result(merge([f.result() for f in futures]))
+            except Exception as e:
+                combined.set_exception(e)
+            return
+        last = futures[-1].result()
+        combined.set_result(last._replace(rowcount=sum(f.result().rowcount for f in futures)))
+
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+
+def _fetch_columns(cursor):
+    """
+    分批取回结果并按列保存
+    :param cursor: 已执行查询的cursor
+    :return: 字段名到数组的dict
+    """
+    names = [d[0] for d in cursor.description]
+    chunks = [[] for _ in names]
+    rows = cursor.fetchmany(_COLUMN_CHUNK)
+    while rows:
+        for chunk, values in zip(chunks, zip(*rows)):
+            chunk.append(_column_array(values))
+        rows = cursor.fetchmany(_COLUMN_CHUNK)
+    return {name: _concat_columns(chunk) for name, chunk in zip(names, chunks)}
+
+
+def _column_array(values):
+    """
+    将一批值转为数组，全为整数或全为浮点数时使用紧凑的类型
+    :param values: 一列中的一批值
+    :return:
+    """
+    if all(type(v) is int for v in values):
+        typecode = 'q'
+    elif all(type(v) is float for v in values):
+        typecode = 'd'
+    else:
+        typecode = None
+    if __numpy__:
+        if typecode is not None:
+            return numpy.array(values, dtype=numpy.int64 if typecode == 'q' else numpy.float64)
+        result = numpy.empty(len(values), dtype=object)
+        result[:] = values
+        return result
+    return array.array(typecode, values) if typecode is not None else list(values)
+
+
+def _concat_columns(chunks):
+    """
+    合并一列的各批数组。各批类型不同时，整数与浮点数合并为浮点数，其他情况为list
+    :param chunks: _column_array得到的数组列表
+    :return:
+    """
+    if __numpy__:
+        return numpy.concatenate(chunks) if chunks else numpy.empty(0, dtype=object)
+    if not chunks:
+        return []
+    typecodes = {chunk.typecode if isinstance(chunk, array.array) else None for chunk in chunks}
+    if len(typecodes) == 1:
+        result = chunks[0]
+        for chunk in chunks[1:]:
+            result.extend(chunk)
+        return result
+    if None not in typecodes:
+        result = array.array('d')
+        for chunk in chunks:
+            result.extend(chunk if chunk.typecode == 'd' else map(float, chunk))
+        return result
+    result = []
+    for chunk in chunks:
+        result.extend(chunk)
+    return result
+
+
+def _valid_request(request):
+    """
+    检查客户端请求的格式
+    :param request: 解码后的请求
+    :return: 是否为(请求号, SQL语句, 预编译参数, 是否可缓存, 优先级, 截止时间)
+    """
+    if not isinstance(request, tuple) or len(request) != 6:
+        return False
+    request_id, execute, data, cacheable, priority, deadline = request
+    return isinstance(request_id, int) and isinstance(execute, str) \
+        and isinstance(data, (type(None), tuple, list)) and isinstance(cacheable, bool) \
+        and isinstance(priority, int) and (deadline is None or isinstance(deadline, (int, float)))
+
+
+def _remote_error(name, message):
+    """
+    重建服务端传回的异常
+    :param name: 异常类名
+    :param message: 异常信息
+    :return:
+    """
+    cls = globals().get(name) or getattr(sqlite3, name, None)
+    if not (isinstance(cls, type) and issubclass(cls, Exception)):
+        cls = SqliteQueueError
+    return cls(message)
+
+
+def _call_remote_callback(callback, plan, execute, future):
+    """
+    客户端的任务完成后调用回调
+    :param callback: 回调
+    :param plan: _callback_plan得到的参数
+    :param execute: 出错时日志中记录的SQL语句
+    :param future: 已完成的future
+    :return:
+    """
+    if future.exception() is not None:
+        _logger.error('Failed to execute task: %s', execute, exc_info=future.exception())
+        return
+    result = future.result()
+    try:
+        callback(**{param: None if index is None else result[index] for param, index in plan})
+    except Exception:
+        _logger.exception('Exception in callback of task: %s', execute)
+
+
+def _shard_index(value, count):
+    """
+    默认的分片函数，整数取模，其他值取crc32后取模，保证跨进程稳定
+    :param value: 分片键的值
+    :param count: 分片数
+    :return: 分片下标
+    """
+    if isinstance(value, float) and value.is_integer():  # SQLite中1与1.0相等，应分到同一分片
+        value = int(value)
+    if isinstance(value, int):
+        return value % count
+    if isinstance(value, str):
+        value = value.encode()
+    elif not isinstance(value, bytes):
+        value = repr(value).encode()
+    return zlib.crc32(value) % count
+
+
+def _simple_equality(args):
+    """
+    判断where的参数是否为单个字段的相等条件
+    :param args: where的参数
+    :return: (字段, 值)，否则返回None
+    """
+    if len(args) == 2 and isinstance(args[0], str) and not isinstance(args[1], (list, tuple, dict, Param)):
+        column, value = args
+    elif len(args) == 1 and isinstance(args[0], dict) and len(args[0]) == 1:
+        column, value = next(iter(args[0].items()))
+        if isinstance(value, (list, dict, Param)):
+            return None
+    else:
+        return None
+    if column.endswith('[=]'):
+        column = column[:-3]
+    if not re.match(r'^[a-zA-Z_]+$', column):  # 带有其他操作符
+        return None
+    return column, value
+
+
+def _condition_key(column, args):
+    """
+    从where的参数中取得字段的相等条件
+    :param column: 字段名
+    :param args: where的参数
+    :return: 字段的值，没有相等条件时返回None
+    """
+    if len(args) == 2 and args[0] == column and not isinstance(args[1], (list, tuple, dict)):
+        return args[1]
+    if len(args) == 3 and args[0] == column and args[1] in ('=', '==') and not isinstance(args[2], (list, dict)):
+        return args[2]
+    if len(args) >= 1 and isinstance(args[0], dict) and (len(args) == 1 or args[1] == 'AND'):
+        for name in (column, column + '[=]'):
+            value = args[0].get(name)
+            if value is not None and not isinstance(value, (list, dict)):
+                return value
+    return None
+
+
+def _order_terms(order):
+    """
+    解析ORDER BY子句
+    :param order: SqlQuery中的排序字段
+    :return: (字段名, 是否降序)的列表
+    """
+    terms = []
+    for term in order.split(','):
+        match = _ORDER_TERM.match(term)
+        if match is None:
+            raise SqliteQueueError('ORDER BY cannot be merged across shards: %s' % order)
+        terms.append((match.group(1), (match.group(2) or '').upper() == 'DESC'))
+    return terms
+
+
+def _sort_value(value):
+    """
+    与sqlite相同的排序：NULL、数字、文本、BLOB
+    """
+    if value is None:
+        return 0, 0
+    if isinstance(value, (int, float)):
+        return 1, value
+    if isinstance(value, str):
+        return 2, value
+    return 3, value
+
+
+def _merge_results(results, order=None, window=None, distinct=False):
+    """
+    合并各分片的查询结果
+    :param results: 各分片的QueryResult
+    :param order: _order_terms解析出的排序字段，None则按分片顺序拼接
+    :param window: 截取的(开始, 结束)下标
+    :param distinct: 是否去除重复行
+    :return: QueryResult
+    """
+    rows = [row for result in results for row in result.data or ()]
+    columns = next((result.columns for result in results if result.columns is not None), None)
+    if distinct:
+        rows = list(OrderedDict.fromkeys(rows))
+    if order:
+        if columns is None:
+            raise SqliteQueueError('Unknown result columns for ORDER BY!')
+        for name, desc in reversed(order):  # 稳定排序，从最后一个字段开始
+            if name not in columns:
+                raise SqliteQueueError('ORDER BY column "%s" is not in the result!' % name)
+            index = columns.index(name)
+            rows.sort(key=lambda row: _sort_value(row[index]), reverse=desc)
+    if window is not None:
+        rows = rows[window[0]:window[1]]
+    return QueryResult(None, rows, -1, columns)
 
 
 def _is_sql(obj):
@@ -565,6 +3473,15 @@ def _parse_dict_condition(obj, conj='AND'):
             else:  # 为IN
                 if o[1] == '!=':  # 不用判断!，已经被转为!=
                     not_ = 'NOT '
+                if len(v) > _IN_LIST_JSON and _HAS_JSON_EACH and all(type(i) in (int, float, str) for i in v):
+                    try:  # NaN与Infinity不是合法的JSON，这时仍用占位符
+                        encoded = json.dumps(v, allow_nan=False)
+                    except ValueError:
+                        encoded = None
+                    if encoded is not None:
+                        cond += ' %s `%s` %sIN (SELECT value FROM json_each(?))' % (conj, o[0], not_)
+                        value_set.append(encoded)
+                        continue
                 cond += ' %s `%s` %sIN (' % (conj, o[0], not_) \
                         + ('?,' * len(v))[:-1] + ')'
             value_set += v